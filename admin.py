@@ -115,6 +115,16 @@ class StatApi(webapp2.RequestHandler):
 
 
 
+class CacheStatApi(webapp2.RequestHandler):
+	''' Hit rates of the in-instance caches of the serving instance '''
+	@auth
+	def get(self):
+		from page import _pages, _responses, _block_cache
+		stats = {'page': _pages.stats(), 'response': _responses.stats(), 'block': _block_cache.local.stats()}
+		self.response.out.write(json.dumps(stats))
+
+
+
 URL_MIGRATE = '/.task/migrate'
 
 class TaskMigrate(webapp2.RequestHandler):
@@ -141,6 +151,7 @@ admin_routes = [
 	(r'/', Main),
 	(r'/stat/task', StatTask),
 	(r'/stat/api/<:.*>', StatApi),
+	(r'/stat/cache', CacheStatApi),
 	(URL_MIGRATE, TaskMigrate),
 	
 ]
\ No newline at end of file
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+''' Caches kept in the instance
+
+The least recently used value goes first:
+
+>>> cache = LRUCache(2)
+>>> cache.set('a', 1)
+>>> cache.set('b', 2)
+>>> cache.get('a')
+1
+>>> cache.set('c', 3)
+>>> sorted(cache.get_multi(['a', 'b', 'c']).items())
+[('a', 1), ('c', 3)]
+
+Values expire after ttl seconds:
+
+>>> cache = LRUCache(10, ttl=0.01)
+>>> cache.set('a', 1)
+>>> time.sleep(0.02)
+>>> cache.get('a') is None
+True
+>>> cache.stats()['misses']
+1
+'''
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+	''' Size bounded in-instance cache, safe to share between request threads
+
+	With ttl, in seconds, values expire: other instances change memcache
+	and datastore behind this cache, so it should be short.
+	'''
+
+	def __init__(self, size, ttl=None):
+		self.size = size
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self._data = OrderedDict()
+		self._lock = threading.Lock()
+
+	def _get(self, key, now):
+		# call with the lock held
+		item = self._data.pop(key, None)
+		if item is None:
+			self.misses += 1
+			return None
+		value, expires = item
+		if expires is not None and expires < now:
+			self.misses += 1
+			return None
+		self._data[key] = item
+		self.hits += 1
+		return value
+
+	def get(self, key):
+		now = time.time()
+		with self._lock:
+			return self._get(key, now)
+
+	def get_multi(self, keys):
+		result = {}
+		now = time.time()
+		with self._lock:
+			for key in keys:
+				value = self._get(key, now)
+				if value is not None:
+					result[key] = value
+		return result
+
+	def set(self, key, value):
+		self.set_multi({key: value})
+
+	def set_multi(self, mapping):
+		expires = time.time() + self.ttl if self.ttl else None
+		with self._lock:
+			for key, value in mapping.iteritems():
+				self._data.pop(key, None)
+				self._data[key] = (value, expires)
+			while len(self._data) > self.size:
+				self._data.popitem(last=False)
+
+	def delete(self, key):
+		with self._lock:
+			self._data.pop(key, None)
+
+	def delete_multi(self, keys):
+		with self._lock:
+			for key in keys:
+				self._data.pop(key, None)
+
+	def stats(self):
+		''' Counters since the instance started '''
+		with self._lock:
+			hits, misses, items = self.hits, self.misses, len(self._data)
+		total = hits + misses
+		return {
+			'hits': hits,
+			'misses': misses,
+			'items': items,
+			'hit_rate': float(hits) / total if total else 0.0,
+		}
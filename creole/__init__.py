@@ -25,6 +25,6 @@
 
 __version__ = '1.2'
 
-from creole.rules import Rules
+from creole.rules import Rules, get_rules
 from creole.parser import Parser
 from creole.document import DocNode
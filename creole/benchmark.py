@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks for the creole parser and HTML emitter.
+
+    Generates synthetic wiki corpora of several kinds and sizes and measures
+    parse time, emit time, objects allocated for the document tree and
+    peak memory of parsing and emitting the document.
+    Runs with plain Python, no App Engine SDK is required:
+
+        python -m creole.benchmark                 # run and compare
+        python -m creole.benchmark --save          # store a new baseline
+        python -m creole.benchmark --sizes 10000 --kinds prose,tables
+
+    Results are compared with the baseline file (benchmark_baseline.json
+    next to this module by default); any measure worse than the baseline
+    by more than the threshold is reported as a regression and makes the
+    exit status 1. A missing baseline is an error, status 2.
+
+    By default only the objects allocated are compared, they do not
+    depend on the machine. Time and memory are compared with --timings,
+    against a baseline saved with --save on the same machine:
+
+        python -m creole.benchmark --save --baseline mine.json
+        python -m creole.benchmark --timings --baseline mine.json
+"""
+
+import gc
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import time
+import timeit
+import Queue
+import multiprocessing
+
+from creole.rules import Rules, get_rules
+from creole.parser import Parser
+from creole.html_emitter import HtmlEmitter
+
+
+SAMPLE = u'''
+==Редактирование
+Нажмите на кнопку 'Правка' внизу или дважды кликните по тексту.
+\\\\ Для создания новой страницы просто перейдите по ее адресу.
+* пункт с [[/ссылка|ссылкой]]
+* пункт с **жирным** текстом
+'''
+
+WORDS = (u'вики позволяет форматировать текст используя специальные символы '
+         u'для создания новой заметки введите в адресной строке урл где она '
+         u'будет находиться страница файлы картинки ссылка заголовок правка '
+         u'история изменений подписка доступ удалить переместить').split()
+
+MEASURES = ('parse', 'emit', 'objects', 'memory')
+# measures which depend on the machine, compared with --timings only
+TIMINGS = ('parse', 'emit', 'memory')
+# baseline entry naming the machine it was saved on
+MACHINE = '_machine'
+# seconds a single case may run before it is taken as hung
+TIMEOUT = 600
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'benchmark_baseline.json')
+# differences below these are noise: ms, ms, objects, KB
+NOISE = {'parse': 1, 'emit': 1, 'objects': 0, 'memory': 1024}
+
+
+#################
+##   Corpora   ##
+#################
+
+def _sentence(r):
+    words = [r.choice(WORDS) for _ in range(r.randint(5, 15))]
+    k = r.randint(0, 9)
+    if k == 0:
+        words[1] = u'**%s**' % words[1]
+    elif k == 1:
+        words[2] = u'//%s//' % words[2]
+    elif k == 2:
+        words[0] = u'{{{ %s }}}' % words[0]
+    return u' '.join(words).capitalize() + u'.'
+
+def prose(r):
+    """Sections of Russian prose like the welcome guide."""
+    lines = [u'=' * r.randint(1, 3) + u' ' + r.choice(WORDS).capitalize()]
+    for _ in range(r.randint(1, 4)):
+        lines.append(u' '.join(_sentence(r) for _ in range(r.randint(2, 6))))
+        lines.append(u'')
+    return u'\n'.join(lines)
+
+def tables(r):
+    """Big tables with headings, links and images in cells."""
+    cols = r.randint(3, 8)
+    rows = [u'|' + u'|'.join(u'=' + r.choice(WORDS) for _ in range(cols)) + u'|']
+    for _ in range(r.randint(10, 50)):
+        cells = []
+        for _ in range(cols):
+            k = r.randint(0, 5)
+            if k == 0:
+                cells.append(u'[[/%s|%s]]' % (r.choice(WORDS), r.choice(WORDS)))
+            elif k == 1:
+                cells.append(u'{{/.files/%s.png}}' % r.choice(WORDS))
+            else:
+                cells.append(r.choice(WORDS))
+        rows.append(u'|' + u'|'.join(cells) + u'|')
+    return u'\n'.join(rows) + u'\n'
+
+def lists(r):
+    """Deep nested bullet and number lists."""
+    items = []
+    level = 0
+    for _ in range(r.randint(20, 80)):
+        level = max(1, min(level + r.randint(-2, 1), 12))
+        items.append(r.choice(u'*#') * level + u' ' + _sentence(r))
+    return u'\n'.join(items) + u'\n'
+
+def links(r):
+    """Link heavy pages: wiki links, urls and images."""
+    out = []
+    for _ in range(r.randint(20, 60)):
+        k = r.randint(0, 3)
+        if k == 0:
+            out.append(u'[[/%s/%s|%s]]' % (r.choice(WORDS), r.choice(WORDS), r.choice(WORDS)))
+        elif k == 1:
+            out.append(u'http://wikinote.me/%s' % r.choice(WORDS))
+        elif k == 2:
+            out.append(u'{{/%s.jpg|%s}}' % (r.choice(WORDS), r.choice(WORDS)))
+        else:
+            out.append(r.choice(WORDS))
+    return u' '.join(out) + u'\n'
+
+def pre(r):
+    """Large preformatted blocks."""
+    lines = [u'{{{']
+    for _ in range(r.randint(20, 200)):
+        lines.append(u'    ' * r.randint(0, 3) + u' '.join(r.choice(WORDS) for _ in range(r.randint(1, 8))))
+    lines.append(u'}}}')
+    return u'\n'.join(lines) + u'\n'
+
+CORPORA = {
+    'prose': prose,
+    'tables': tables,
+    'lists': lists,
+    'links': links,
+    'pre': pre,
+}
+
+def corpus(kind, size, seed=0):
+    """Return a document of the given kind, at least size characters long."""
+
+    r = random.Random(seed)
+    make = CORPORA[kind]
+    parts = []
+    length = 0
+    while length < size:
+        part = make(r)
+        parts.append(part)
+        parts.append(u'\n')
+        length += len(part) + 1
+    return u''.join(parts)
+
+
+##################
+##   Measures   ##
+##################
+
+def _best(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def _measure(kind, size, repeat, queue):
+    """Run in a separate process, so peak memory belongs to this case."""
+
+    text = corpus(kind, size)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    gc.collect()
+    objects = len(gc.get_objects())
+    document = Parser(text).parse()
+    objects = len(gc.get_objects()) - objects
+    html = HtmlEmitter(document).emit()
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+
+    parse = _best(lambda: Parser(text).parse(), repeat)
+    emit = _best(lambda: HtmlEmitter(document).emit(), repeat)
+    queue.put({
+        'parse': parse * 1000,
+        'emit': emit * 1000,
+        'objects': objects,
+        'memory': memory,
+    })
+
+def measure(kind, size, repeat=3):
+    """
+    Return parse and emit time in ms, number of objects allocated
+    for the document tree and peak memory growth of parsing and
+    emitting the document in KB.
+    """
+
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure,
+                                      args=(kind, size, repeat, queue))
+    process.start()
+    deadline = time.time() + TIMEOUT
+    try:
+        while True:
+            try:
+                return queue.get(timeout=1)
+            except Queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError('%s-%d: benchmark process exited '
+                                       'with code %s' % (kind, size,
+                                                         process.exitcode))
+                if time.time() > deadline:
+                    raise RuntimeError('%s-%d: no result in %d seconds'
+                                       % (kind, size, TIMEOUT))
+    finally:
+        process.join(5)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+
+def bench_rules(number=200):
+    """Compare convert() with freshly compiled and with shared rules."""
+
+    def convert(rules):
+        return HtmlEmitter(Parser(SAMPLE, rules).parse()).emit()
+
+    results = []
+    for name, make in (('fresh Rules()', lambda: Rules()),
+                       ('get_rules()', lambda: get_rules())):
+        t = timeit.timeit(lambda: convert(make()), number=number)
+        results.append((name, t / number * 1000))
+    return results
+
+
+################
+##   Runner   ##
+################
+
+def run(kinds, sizes, repeat=3, out=sys.stdout):
+    results = {}
+    for kind in kinds:
+        for size in sizes:
+            name = '%s-%d' % (kind, size)
+            results[name] = measure(kind, size, repeat)
+            out.write('%-16s parse %9.2f ms  emit %9.2f ms  '
+                      'objects %8d  parse+emit memory %7d KB\n' % ((name,) +
+                      tuple(results[name][m] for m in MEASURES)))
+    return results
+
+def compare(results, baseline, threshold, measures=MEASURES, out=sys.stdout):
+    """Report measures worse than the baseline, return their number."""
+
+    regressions = 0
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for m in measures:
+            old = baseline[name][m]
+            new = results[name][m]
+            if old <= 0 or new - old <= NOISE[m]:
+                continue
+            change = float(new - old) / old
+            if change > threshold:
+                regressions += 1
+                out.write('REGRESSION %-16s %-8s %10.2f -> %10.2f (+%d%%)\n'
+                          % (name, m, old, new, change * 100))
+    return regressions
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--kinds', default=','.join(sorted(CORPORA)))
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed relative regression, 0.2 is 20%%')
+    parser.add_argument('--save', action='store_true',
+                        help='store results as the new baseline')
+    parser.add_argument('--timings', action='store_true',
+                        help='also compare time and memory, the baseline '
+                             'must be saved on this machine')
+    args = parser.parse_args(argv)
+
+    for name, ms in bench_rules():
+        print '%-16s %8.3f ms/convert' % (name, ms)
+
+    kinds = args.kinds.split(',')
+    sizes = [int(s) for s in args.sizes.split(',')]
+    results = run(kinds, sizes, args.repeat)
+
+    if args.save:
+        results[MACHINE] = platform.node()
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print 'Baseline saved to', args.baseline
+        return 0
+
+    if not os.path.exists(args.baseline):
+        sys.stderr.write('No baseline in %s, run with --save to store one\n'
+                         % args.baseline)
+        return 2
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    measures = [m for m in MEASURES if m not in TIMINGS]
+    if args.timings:
+        if baseline.get(MACHINE) != platform.node():
+            sys.stderr.write('Baseline %s was not saved on this machine, run '
+                             'with --save to store one\n' % args.baseline)
+            return 2
+        measures = MEASURES
+    regressions = compare(results, baseline, args.threshold, measures)
+    print '%d regressions against %s' % (regressions, args.baseline)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
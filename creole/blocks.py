@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+from creole.parser import Parser
+from creole.multi_emitter import MultiEmitter, Outputs
+
+
+class BlockRenderer(object):
+    """
+    Render a document part by part, reusing the cached HTML of the parts
+    that did not change since the last render.
+
+    The document is split after every empty line. An empty line returns
+    the parser to the document level with no open text node, so the HTML
+    of the document is exactly the concatenation of the HTML of its parts.
+    Constructs that span several lines - lists continued by a text line,
+    tables, pre blocks with empty lines inside - never contain an empty
+    line token and always stay within one part.
+
+    The cache is any object with get_multi(keys) returning a dict of the
+    found keys and set_multi(mapping). The salt is mixed into the keys and
+    should change whenever the emitted HTML changes.
+
+    render() returns the HTML only, render_outputs() the Outputs of a
+    MultiEmitter; both are cached per part under different keys.
+    stream() writes the HTML part by part as it is rendered.
+    """
+
+    def __init__(self, cache=None, salt='', rules=None,
+                 parser=Parser, emitter=MultiEmitter):
+        self.cache = cache
+        self.salt = salt
+        self.rules = rules
+        self.parser = parser
+        self.emitter = emitter
+
+    def split(self, raw):
+        """Return the list of (key, tokens) parts of the raw text."""
+
+        parts = []
+        tokens = []
+        digest = hashlib.sha1(self.salt)
+        for token in self.parser(u'', self.rules).scan_blocks(raw):
+            name, groups, source = token
+            tokens.append(token)
+            digest.update(name)
+            digest.update('\0')
+            digest.update(source.encode('utf-8'))
+            digest.update('\0')
+            if name == 'line':
+                parts.append((digest.hexdigest(), tokens))
+                tokens = []
+                digest = hashlib.sha1(self.salt)
+        if tokens:
+            parts.append((digest.hexdigest(), tokens))
+        return parts
+
+    def render_part(self, tokens, outputs=False):
+        """Parse and emit a single part of the document."""
+
+        parser = self.parser(u'', self.rules)
+        parser.parse_blocks(tokens)
+        emitter = self.emitter(parser.root)
+        if outputs:
+            return emitter.emit_outputs().to_tuple()
+        return emitter.emit()
+
+    def _render(self, raw, outputs):
+        parts = self.split(raw)
+        if outputs:
+            parts = [('o' + key, tokens) for key, tokens in parts]
+        cached = {}
+        if self.cache is not None and parts:
+            cached = self.cache.get_multi(list(set(k for k, t in parts)))
+        fresh = {}
+        for key, tokens in parts:
+            result = cached.get(key)
+            if result is None:
+                result = fresh.get(key)
+                if result is None:
+                    result = fresh[key] = self.render_part(tokens, outputs)
+            yield result
+        if self.cache is not None and fresh:
+            self.cache.set_multi(fresh)
+
+    def render(self, raw):
+        """Return the HTML of the raw text, rendering only changed parts."""
+
+        return u''.join(self._render(raw, False))
+
+    def stream(self, raw, write):
+        """
+        Write the HTML of the raw text to the write callable part by part,
+        like HtmlEmitter.stream(), rendering only changed parts.
+        """
+
+        for html in self._render(raw, False):
+            write(html)
+
+    def render_outputs(self, raw):
+        """
+        Return the Outputs of the raw text: HTML, plain text, headings,
+        links and images, rendering only changed parts.
+        """
+
+        return Outputs.join(Outputs.from_tuple(values)
+                            for values in self._render(raw, True))
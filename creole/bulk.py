@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Bulk rendering of many creole documents.
+
+    Documents are rendered across a multiprocessing pool, in chunks, and the
+    results come back in the order of the sources. Where processes can not
+    be started (the App Engine sandbox has no multiprocessing) or are not
+    worth it, the documents are rendered in the current process.
+
+    The command line re-renders a dump of History texts, one JSON object
+    per line with the creole source in "text"; every object is written
+    back with the rendered "html" added:
+
+        python -m creole.bulk history.json rendered.json
+        python -m creole.bulk --processes 4 --chunksize 100 < in > out
+"""
+
+import sys
+import json
+import collections
+
+from creole.parser import Parser
+from creole.html_emitter import HtmlEmitter
+
+
+# below this number of documents a pool costs more than it saves
+MIN_POOL_SOURCES = 64
+
+_rules = None
+_emitter = None
+
+def _init(rules, emitter):
+    global _rules, _emitter
+    _rules = rules
+    _emitter = emitter
+
+def render(text, rules=None, emitter=None):
+    """Return the HTML of a single creole text."""
+
+    emitter = emitter or _emitter or HtmlEmitter
+    return emitter(Parser(text, rules or _rules).parse()).emit()
+
+def _pool(processes, rules, emitter):
+    """Return a started pool or None where pools are unavailable."""
+
+    try:
+        import multiprocessing
+        return multiprocessing.Pool(processes, _init, (rules, emitter))
+    except (ImportError, NotImplementedError, OSError):
+        return None
+
+def _windows(sources, size):
+    window = []
+    for text in sources:
+        window.append(text)
+        if len(window) >= size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+def iter_render(sources, processes=None, chunksize=32, rules=None,
+                emitter=None):
+    """
+    Yield the HTML of every creole text of the sources iterable, in order.
+
+    The sources are consumed a window of a few chunks per process at a
+    time, so a dump of any size is rendered in bounded memory. processes
+    defaults to the number of CPUs, 1 renders in the current process.
+    The emitter is the class, or factory, the document trees are given to.
+    """
+
+    if processes is None:
+        try:
+            import multiprocessing
+            processes = multiprocessing.cpu_count()
+        except (ImportError, NotImplementedError):
+            processes = 1
+
+    windows = _windows(sources, max(processes, 1) * chunksize * 4)
+    pool = None
+    for window in windows:
+        if processes > 1 and len(window) >= MIN_POOL_SOURCES:
+            pool = _pool(processes, rules, emitter)
+            # start the pool once, or render in process from now on
+            processes = 1
+        if pool is None:
+            for text in window:
+                yield render(text, rules, emitter)
+            continue
+        try:
+            for html in pool.imap(render, window, chunksize):
+                yield html
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+def render_many(sources, processes=None, chunksize=32, rules=None,
+                emitter=None):
+    """Return the list of HTML of the creole texts, in order."""
+
+    return list(iter_render(sources, processes, chunksize, rules, emitter))
+
+
+#################
+##   Command   ##
+#################
+
+def _is_wiki(record):
+    return record.get('markup', 'WIKI') == 'WIKI'
+
+def rerender_dump(infile, outfile, processes=None, chunksize=32, rules=None):
+    """
+    Re-render a dump of History records, one JSON object per line.
+
+    Records with markup other than WIKI keep their text as the HTML,
+    like the page editor does. Return the number of records written.
+    """
+
+    records = collections.deque()
+    def sources():
+        for line in infile:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            records.append(record)
+            yield record['text'] if _is_wiki(record) else u''
+
+    count = 0
+    for html in iter_render(sources(), processes, chunksize, rules):
+        record = records.popleft()
+        record['html'] = html if _is_wiki(record) else record['text']
+        outfile.write(json.dumps(record) + '\n')
+        count += 1
+    return count
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('input', nargs='?', default='-',
+                        help='dump of History records, - for stdin')
+    parser.add_argument('output', nargs='?', default='-',
+                        help='rendered records, - for stdout')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes, 1 renders in this process')
+    parser.add_argument('--chunksize', type=int, default=32)
+    args = parser.parse_args(argv)
+
+    infile = sys.stdin if args.input == '-' else open(args.input)
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        count = rerender_dump(infile, outfile, args.processes, args.chunksize)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+    sys.stderr.write('%d records rendered\n' % count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
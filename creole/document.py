@@ -4,14 +4,21 @@
 class DocNode(object):
     """
     A node in the document.
+
+    Large pages produce many thousands of nodes, so the node has no
+    per-instance __dict__: the slots cover every attribute the parser sets.
     """
 
+    __slots__ = ('children', 'parent', 'kind', 'content',
+                 'level', 'sect', 'args')
+
     def __init__(self, kind='', parent=None, content=None):
         self.children = []
         self.parent = parent
         self.kind = kind
         self.content = content
+        self.level = None   # header and list nesting level
+        self.sect = None    # preformatted block kind, from #!kind
+        self.args = None    # macro arguments
         if self.parent is not None:
             self.parent.children.append(self)
-
-
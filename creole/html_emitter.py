@@ -137,6 +137,49 @@ XXX This might be considered a bug, but it's impossible to detect in general.
 >>> wiki_parse(u'Lorem WikiWord iPsum sit ameT.')
 <p>Lorem <a href="WikiWord">WikiWord</a> iPsum sit ameT.</p>
 
+Macros without a registered function are shown as they were written:
+>>> parse(u'<<children(/a)|Pages>> <<recent>>')
+<p>&lt;&lt;children(/a)|Pages&gt;&gt; &lt;&lt;recent&gt;&gt;</p>
+
+>>> def upper(emitter, node):
+...     return emitter.html_escape(node.args.upper())
+>>> print HtmlEmitter(creole.Parser(u'<<upper(a<b)>>').parse(),
+...                   macros={'upper': upper}).emit()
+<p>A&lt;B</p>
+
+Subclasses may still override the *_emit methods of containers:
+>>> class Quoted(HtmlEmitter):
+...     def paragraph_emit(self, node):
+...         return u'<p class="q">%s</p>' % self.emit_children(node)
+>>> print Quoted(creole.Parser(u'a **b**\n\n* c').parse()).emit()
+<p class="q">a <b>b</b></p><ul>
+<li>c</li>
+</ul>
+
+>>> parse(u'{{{\ntest\n\ntest')
+<p>{{{ test</p><p>test</p>
+
+>>> parse(u'|a|\n\n|b|')
+<table><tr><td>a</td></tr></table>
+<table><tr><td>b</td></tr></table>
+
+Block splitting is linear, adversarial input must not stall the parser:
+>>> import time
+>>> def fast(text):
+...     start = time.time()
+...     HtmlEmitter(creole.Parser(text).parse()).emit()
+...     return time.time() - start < 1
+>>> fast(u'{{{\n' + u'test\n' * 20000)
+True
+>>> fast(u'{{{\n\n' * 5000)
+True
+>>> fast(u'|' * 20000)
+True
+>>> fast(u'|' + u' ' * 20000 + u'test')
+True
+>>> fast(u'= ' + u' ' * 20000 + u'test')
+True
+
 """
 
 import re
@@ -149,12 +192,42 @@ class HtmlEmitter(object):
     """
     Generate HTML output for the document
     tree consisting of DocNodes.
+
+    Container nodes are described by the tags table and are walked with
+    an explicit stack, so the output is written to the sink fragment by
+    fragment and deep nesting does not hit the recursion limit. Other
+    nodes, and containers whose *_emit method a subclass overrides, are
+    emitted whole by their *_emit methods.
+
+    Macros are looked up by name in the macros mapping; the function is
+    called with the emitter and the macro node and returns HTML.
     """
 
-    def __init__(self, root, link_rules=None):
+    # Opening and closing markup of the container nodes:
+    tags = {
+        'document': (u'', u''),
+        'paragraph': (u'<p>', u'</p>\n'),
+        'bullet_list': (u'<ul>\n', u'</ul>\n'),
+        'number_list': (u'<ol>\n', u'</ol>\n'),
+        'list_item': (u'<li>', u'</li>\n'),
+        'table': (u'<table>\n', u'</table>\n'),
+        'table_row': (u'<tr>', u'</tr>\n'),
+        'table_cell': (u'<td>', u'</td>'),
+        'table_head': (u'<th>', u'</th>'),
+        'emphasis': (u'<i>', u'</i>'),
+        'strong': (u'<b>', u'</b>'),
+    }
+
+    def __init__(self, root, link_rules=None, macros=None):
         self.root = root
         self.link_rules = link_rules or LinkRules()
-        self.root = root
+        self.macros = macros or {}
+        # containers walked by stream() itself, unless overridden
+        cls = self.__class__
+        self.walked = dict(
+            (kind, tag) for kind, tag in self.tags.iteritems()
+            if getattr(cls, kind + '_emit', cls._container_emit).im_func
+            is HtmlEmitter._container_emit.im_func)
 
     def get_text(self, node):
         """Try to emit whatever text is in the node."""
@@ -170,10 +243,24 @@ class HtmlEmitter(object):
     def attr_escape(self, text):
         return self.html_escape(text).replace('"', '&quot')
 
-    # *_emit methods for emitting nodes of the document:
-
-    def document_emit(self, node):
-        return self.emit_children(node)
+    # *_emit methods for emitting nodes of the document, stream() writes
+    # the containers from the tags table without calling them:
+
+    def _container_emit(self, node):
+        start, end = self.tags[node.kind]
+        return start + self.emit_children(node) + end
+
+    document_emit = _container_emit
+    paragraph_emit = _container_emit
+    bullet_list_emit = _container_emit
+    number_list_emit = _container_emit
+    list_item_emit = _container_emit
+    table_emit = _container_emit
+    table_row_emit = _container_emit
+    table_cell_emit = _container_emit
+    table_head_emit = _container_emit
+    emphasis_emit = _container_emit
+    strong_emit = _container_emit
 
     def text_emit(self, node):
         return self.html_escape(node.content)
@@ -181,36 +268,6 @@ class HtmlEmitter(object):
     def separator_emit(self, node):
         return u'<hr>';
 
-    def paragraph_emit(self, node):
-        return u'<p>%s</p>\n' % self.emit_children(node)
-
-    def bullet_list_emit(self, node):
-        return u'<ul>\n%s</ul>\n' % self.emit_children(node)
-
-    def number_list_emit(self, node):
-        return u'<ol>\n%s</ol>\n' % self.emit_children(node)
-
-    def list_item_emit(self, node):
-        return u'<li>%s</li>\n' % self.emit_children(node)
-
-    def table_emit(self, node):
-        return u'<table>\n%s</table>\n' % self.emit_children(node)
-
-    def table_row_emit(self, node):
-        return u'<tr>%s</tr>\n' % self.emit_children(node)
-
-    def table_cell_emit(self, node):
-        return u'<td>%s</td>' % self.emit_children(node)
-
-    def table_head_emit(self, node):
-        return u'<th>%s</th>' % self.emit_children(node)
-
-    def emphasis_emit(self, node):
-        return u'<i>%s</i>' % self.emit_children(node)
-
-    def strong_emit(self, node):
-        return u'<b>%s</b>' % self.emit_children(node)
-
     def header_emit(self, node):
         return u'<h%d>%s</h%d>\n' % (
             node.level, self.html_escape(node.content), node.level)
@@ -248,7 +305,16 @@ class HtmlEmitter(object):
             self.attr_escape(target), self.attr_escape(text))
 
     def macro_emit(self, node):
-        raise NotImplementedError
+        macro = self.macros.get(node.content)
+        if macro is not None:
+            return macro(self, node)
+        source = node.content
+        if node.args:
+            source += u'(%s)' % node.args
+        text = self.get_text(node)
+        if text != node.content:
+            source += u'|' + text
+        return self.html_escape(u'<<%s>>' % source)
 
     def break_emit(self, node):
         return u"<br>"
@@ -261,16 +327,50 @@ class HtmlEmitter(object):
 
         raise TypeError
 
+    def stream(self, write, node=None):
+        """
+        Write the HTML of the node, the whole document by default,
+        to the write callable: list.append, file.write, response.out.write.
+        """
+
+        tags = self.walked
+        leaves = {}
+        stack = [node or self.root]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node = pop()
+            if node.__class__ is unicode:
+                # closing tag of a container
+                write(node)
+                continue
+            kind = node.kind
+            tag = tags.get(kind)
+            if tag is None:
+                emit = leaves.get(kind)
+                if emit is None:
+                    emit = leaves[kind] = getattr(self, '%s_emit' % kind,
+                                                  self.default_emit)
+                write(emit(node))
+            else:
+                write(tag[0])
+                push(tag[1])
+                stack.extend(reversed(node.children))
+
     def emit_children(self, node):
         """Emit all the children of a node."""
 
-        return u''.join([self.emit_node(child) for child in node.children])
+        out = []
+        for child in node.children:
+            self.stream(out.append, child)
+        return u''.join(out)
 
     def emit_node(self, node):
         """Emit a single node."""
 
-        emit = getattr(self, '%s_emit' % node.kind, self.default_emit)
-        return emit(node)
+        out = []
+        self.stream(out.append, node)
+        return u''.join(out)
 
     def emit(self):
         """Emit the document represented by self.root DOM tree."""
@@ -280,5 +380,6 @@ class HtmlEmitter(object):
 if __name__=="__main__":
     import sys
     document = Parser(unicode(sys.stdin.read(), 'utf-8', 'ignore')).parse()
-    sys.stdout.write(HtmlEmitter(document).emit().encode('utf-8', 'ignore'))
+    HtmlEmitter(document).stream(
+        lambda html: sys.stdout.write(html.encode('utf-8', 'ignore')))
 
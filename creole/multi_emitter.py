@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+ur"""
+HTML emitter that also collects, in the same walk over the document tree,
+the plain text of the document for indexing, its heading outline and the
+targets of its links and images.
+
+>>> import creole
+>>> def outputs(text):
+...     return MultiEmitter(creole.Parser(text).parse()).emit_outputs()
+>>> o = outputs(u'= Title\nSome **bold** [[/a|link]]\n\n* one\n* {{/i.png|two}}\n')
+>>> print o.html
+<h1>Title</h1>
+<p>Some <b>bold</b> <a href="/a">link</a></p>
+<ul>
+<li>one</li>
+<li><img src="/i.png" alt="two"></li>
+</ul>
+<BLANKLINE>
+>>> print o.text
+Title
+Some bold link
+one
+two
+>>> o.headings, o.links, o.images
+([(1, u'Title')], [u'/a'], [u'/i.png'])
+
+>>> o = Outputs.join([outputs(u'[[/a]] [[/b]]'), outputs(u'[[/b]]\n== Sub')])
+>>> o.text, o.headings, o.links
+(u'/a /b\n/b\nSub', [(2, u'Sub')], [u'/a', u'/b'])
+"""
+
+from creole.html_emitter import HtmlEmitter
+
+
+class Outputs(object):
+    """Everything emitted for a document in one pass."""
+
+    __slots__ = ('html', 'text', 'headings', 'links', 'images')
+
+    def __init__(self, html=u'', text=u'', headings=(), links=(), images=()):
+        self.html = html
+        self.text = text
+        self.headings = list(headings)  # (level, title) in document order
+        self.links = list(links)        # unique link targets in order
+        self.images = list(images)      # unique image targets in order
+
+    def to_tuple(self):
+        return (self.html, self.text, self.headings, self.links, self.images)
+
+    @classmethod
+    def from_tuple(cls, values):
+        return cls(*values)
+
+    @classmethod
+    def join(cls, parts):
+        """Combine the outputs of consecutive parts of a document."""
+
+        result = cls()
+        html = []
+        text = []
+        for part in parts:
+            html.append(part.html)
+            if part.text:
+                text.append(part.text)
+            result.headings.extend(part.headings)
+            _merge(result.links, part.links)
+            _merge(result.images, part.images)
+        result.html = u''.join(html)
+        result.text = u'\n'.join(text)
+        return result
+
+def _merge(targets, more):
+    seen = set(targets)
+    for target in more:
+        if target not in seen:
+            seen.add(target)
+            targets.append(target)
+
+
+class MultiEmitter(HtmlEmitter):
+    """
+    HtmlEmitter collecting the plain text, headings, links and images
+    while the HTML is written, see emit_outputs().
+
+    Text of different blocks - paragraphs, list items, table cells,
+    headers and preformatted blocks - is separated by new lines.
+    """
+
+    # nodes whose text belongs to the enclosing block
+    inline = frozenset(('emphasis', 'strong', 'link'))
+
+    def __init__(self, root, link_rules=None, macros=None):
+        super(MultiEmitter, self).__init__(root, link_rules, macros)
+        self.text = []
+        self.headings = []
+        self.links = []
+        self.images = []
+        self._seen = set()
+        self._block = None
+
+    def add_text(self, node, text, block=False):
+        """Add the text of the node to the plain text of its block."""
+
+        parent = node if block else node.parent
+        while parent.kind in self.inline and parent.parent is not None:
+            parent = parent.parent
+        if parent is not self._block:
+            if self.text:
+                self.text.append(u'\n')
+            self._block = parent
+        self.text.append(text)
+
+    def add_target(self, targets, target):
+        if (targets is self.links, target) not in self._seen:
+            self._seen.add((targets is self.links, target))
+            targets.append(target)
+
+    def text_emit(self, node):
+        self.add_text(node, node.content)
+        return super(MultiEmitter, self).text_emit(node)
+
+    def header_emit(self, node):
+        self.headings.append((node.level, node.content))
+        self.add_text(node, node.content, block=True)
+        return super(MultiEmitter, self).header_emit(node)
+
+    def code_emit(self, node):
+        self.add_text(node, node.content)
+        return super(MultiEmitter, self).code_emit(node)
+
+    def preformatted_emit(self, node):
+        self.add_text(node, node.content, block=True)
+        return super(MultiEmitter, self).preformatted_emit(node)
+
+    def break_emit(self, node):
+        self.add_text(node, u' ')
+        return super(MultiEmitter, self).break_emit(node)
+
+    def link_emit(self, node):
+        self.add_target(self.links, node.content)
+        if not node.children:
+            self.add_text(node, node.content)
+        return super(MultiEmitter, self).link_emit(node)
+
+    def image_emit(self, node):
+        self.add_target(self.images, node.content)
+        self.add_text(node, self.get_text(node))
+        return super(MultiEmitter, self).image_emit(node)
+
+    def emit_outputs(self):
+        """Emit the document, return its Outputs."""
+
+        html = self.emit()
+        return Outputs(html, u''.join(self.text), self.headings,
+                       self.links, self.images)
@@ -4,10 +4,32 @@
 import re
 import sys
 
-from creole.rules import Rules
+from creole.rules import get_rules
 from creole.document import DocNode
 
 
+_pre_kind_re = re.compile(r'\w*', re.U)
+
+
+class _Groups(object):
+    """
+    Groups of a match for the _*_repl handlers, read one by one when a
+    handler asks for them instead of building the groupdict() of every
+    group of the rules for each match.
+    """
+
+    __slots__ = ('match',)
+
+    def __init__(self, match):
+        self.match = match
+
+    def get(self, name, default=None):
+        try:
+            return self.match.group(name)
+        except IndexError:
+            # not a group of these rules
+            return default
+
 class Parser(object):
     """
     Parse the raw text and create a document object
@@ -16,11 +38,13 @@ class Parser(object):
     A separate instance should be created for parsing a new document.
     The first parameter is the raw text to be parsed. An optional second
     argument is the Rules object to use. You can customize the parsing
-    rules to enable optional features or extend the parser.
+    rules to enable optional features or extend the parser. By default
+    the shared rules from get_rules() are used, so the regular expressions
+    are compiled only once per process.
     """
 
     def __init__(self, raw, rules=None):
-        self.rules = rules or Rules()
+        self.rules = rules or get_rules()
         self.raw = raw
         self.root = DocNode('document', None)
         self.cur = self.root        # The most recent document node
@@ -218,29 +242,218 @@ class Parser(object):
             self.text = DocNode('text', self.cur, u'')
         self.text.content += groups.get('escaped_char', u'')
 
-    def _char_repl(self, groups):
-        if self.text is None:
-            self.text = DocNode('text', self.cur, u'')
-        self.text.content += groups.get('char', u'')
-
     def parse_inline(self, raw):
         """Recognize inline elements inside blocks."""
 
         self.parse_re(raw, self.rules.inline_re)
 
+    def _dispatch(self, rules_re):
+        """
+        Return the table of _*_repl handlers indexed by the group numbers
+        of the compiled rules, so a match is dispatched by its lastindex.
+        Plain text groups (char and chars) map to None, parse_re appends
+        them to the current text node itself.
+        """
+
+        tables = self.rules.dispatch
+        key = (self.__class__, rules_re)
+        table = tables.get(key)
+        if table is None:
+            table = [None] * (rules_re.groups + 1)
+            for name, index in rules_re.groupindex.iteritems():
+                if name not in ('char', 'chars'):
+                    table[index] = getattr(self.__class__, '_%s_repl' % name,
+                                           None)
+            tables[key] = table
+        return table
+
     def parse_re(self, raw, rules_re):
         """Parse a fragment according to the compiled rules."""
 
+        table = self._dispatch(rules_re)
         for match in rules_re.finditer(raw):
-            groups = dict((k, v) for (k, v)
-                          in match.groupdict().iteritems()
-                          if v is not None)
-            name = match.lastgroup
-            function = getattr(self, '_%s_repl' % name)
-            function(groups)
+            function = table[match.lastindex]
+            if function is None:
+                if self.text is None:
+                    self.text = DocNode('text', self.cur, u'')
+                self.text.content += match.group()
+            else:
+                function(self, _Groups(match))
+
+    def scan_blocks(self, raw):
+        """
+        Split the raw text into block tokens: (name, groups, source)
+        triples, where name selects the _*_repl handler for the groups.
+
+        The text is scanned line by line and every line is looked at a
+        constant number of times, so splitting is linear in the size of
+        the text. Matching block_re instead backtracks over the rest of
+        the document on an unterminated pre block or a long table row.
+        The blocks are the same block_re finds, with all its corner cases
+        (an empty line swallowed by the block before it, a header text on
+        the next line), so the handlers build the same tree.
+        """
+
+        lines = raw.split(u'\n')
+        count = len(lines)
+        blank = [not line.strip() for line in lines]
+        # nonblank[i] is the first non-empty line at or after line i,
+        # closing[i] is the first pre closing line at or after line i
+        nonblank = [None] * (count + 1)
+        closing = [None] * (count + 1)
+        for i in xrange(count - 1, -1, -1):
+            line = lines[i]
+            nonblank[i] = nonblank[i + 1] if blank[i] else i
+            if line[:3] == u'}}}' and not line[3:].strip():
+                closing[i] = i
+            else:
+                closing[i] = closing[i + 1]
+
+        i = 0
+        while i < count:
+            line = lines[i]
+            end = i          # the last line of the block
+            absorb = True    # swallow the empty lines after the block
+            groups = {}
+            stripped = line.lstrip()
+            if blank[i]:
+                name = 'line'
+                end = (nonblank[i] or count) - 1
+            elif stripped[:1] == u'=':
+                name = 'head'
+                text = stripped.lstrip(u'=')
+                groups['head_head'] = stripped[:len(stripped) - len(text)]
+                if not text.strip():
+                    # the header text is on the next non-empty line
+                    end = nonblank[i + 1]
+                    if end is None:
+                        end = count - 1
+                        text = u''
+                    else:
+                        text = lines[end]
+                text = text.strip()
+                if text[-1:] != u'=':
+                    # a line of = after the header belongs to it
+                    after = nonblank[end + 1]
+                    if after is not None and not lines[after].strip().strip(u'='):
+                        end = after
+                groups['head_text'] = text.rstrip(u'=')
+            elif stripped.rstrip() == u'----':
+                name = 'separator'
+            elif line[:3] == u'{{{' and self._scan_pre(lines, nonblank,
+                                                      closing, i, groups):
+                name = 'pre'
+                end = groups.pop('end')
+            elif self._scan_list(lines, i) is not None:
+                name = 'list'
+                absorb = False
+                end = self._scan_list(lines, i)
+            elif stripped[:1] == u'|':
+                name = 'table'
+                if stripped[1:].rstrip()[-1:] != u'|':
+                    # a lone | on the next non-empty line ends this row
+                    after = nonblank[i + 1]
+                    if after is not None and lines[after].strip() == u'|':
+                        end = after
+            else:
+                name = 'text'
+                absorb = False
+                if (self.rules.bloglike_lines and line[-1:] != u'\\' and
+                        i + 1 < count and not blank[i + 1]):
+                    name = 'break'
+                    groups['break'] = u'\n'
+                    groups['text'] = line
+                    line += u'\n'
+
+            source = u'\n'.join(lines[i:end + 1]) if end > i else line
+            groups.setdefault(name, source)
+            yield name, groups, source
+
+            i = end + 1
+            if absorb and name != 'line':
+                i = nonblank[i] or count
+            # the block ended on an empty line, which is seen again
+            if name != 'line' and i < count and not lines[i - 1]:
+                yield 'line', {'line': u''}, u''
+
+    def _scan_list(self, lines, i):
+        """
+        Return the last line of the list starting at line i, or None.
+        A bullet alone on its line takes the next line as its text.
+        """
+
+        bullet = lines[i].lstrip(u' \t')
+        if bullet[:1] not in (u'*', u'#') or bullet[1:2] in (u'*', u'#'):
+            return None
+        end = i
+        if len(bullet) == 1:
+            if i + 1 == len(lines):
+                return None
+            end += 1
+        while (end + 1 < len(lines) and
+               lines[end + 1].lstrip(u' \t')[:1] in (u'*', u'#')):
+            end += 1
+        return end
+
+    def _scan_pre(self, lines, nonblank, closing, i, groups):
+        """
+        Find the pre block opened at line i. On success set pre_text,
+        pre_kind and the closing line as end in groups and return True.
+        """
+
+        if lines[i][3:].strip() or i + 1 == len(lines):
+            return False
+        first = nonblank[i + 1]     # leading empty lines are dropped
+        if first is None or closing[first] is None:
+            return False
+        line = lines[first]
+        groups['pre_kind'] = None
+        if line[:2] == u'#!':
+            # #!kind followed by the end of line or by spaces, which may
+            # continue over the next lines up to the end of a line
+            kind = _pre_kind_re.match(line, 2)
+            rest = line[kind.end():]
+            last = None
+            if not rest.strip() and first + 1 < len(lines):
+                after = nonblank[first + 1]
+                if after is not None:
+                    if closing[after + 1] is not None:
+                        last = after
+                    elif closing[after] == after and (
+                            after - 1 > first or rest and after - 1 == first):
+                        last = after - 1
+                if last is None and not rest and closing[first + 1] is not None:
+                    last = first
+            elif rest[:1].isspace() and closing[first + 1] is not None:
+                last = first
+            if last is not None:
+                end = closing[last + 1]
+                groups['pre_kind'] = kind.group()
+                groups['pre_text'] = u'\n'.join(lines[first:end])
+                if end == last + 1:
+                    groups['pre_text'] += u'\n'
+                groups['end'] = end
+                return True
+        end = closing[first + 1]
+        if end is not None:
+            groups['pre_text'] = u'\n'.join(lines[first:end])
+        elif closing[first] == first:
+            # a closing line right after the opening one
+            end = first
+            groups['pre_text'] = u'\n'
+        else:
+            return False
+        groups['end'] = end
+        return True
+
+    def parse_blocks(self, tokens):
+        """Build the document from block tokens made by scan_blocks."""
+
+        for name, groups, source in tokens:
+            getattr(self, '_%s_repl' % name)(groups)
 
     def parse(self):
         """Parse the text given as self.raw and return DOM tree."""
 
-        self.parse_re(self.raw, self.rules.block_re)
+        self.parse_blocks(self.scan_blocks(self.raw))
         return self.root
\ No newline at end of file
@@ -3,6 +3,7 @@
 
 import re
 import sys
+import threading
 
 
 class LinkRules(object):
@@ -55,6 +56,14 @@ class Rules(object):
     linebreak = r'(?P<break> \\\\ )'
     escape = r'(?P<escape> ~ (?P<escaped_char>\S) )'
     char =  r'(?P<char> . )'
+    # Runs of plain text consumed in one step instead of char by char.
+    # A run stops at every character that may start inline markup, and
+    # before a url that follows a separator, so it never swallows a
+    # position where another rule would match.
+    chars = r'''(?P<chars>
+            (?: [^\s.,:;!?()=\[{<*/\\~%s] |
+                (?!\n) [\s.,:;!?()=] (?! (?: %s ) : ) )+
+        )'''
 
     # For the block elements:
     separator = r'(?P<separator> ^ \s* ---- \s* $ )' # horizontal line
@@ -108,11 +117,23 @@ class Rules(object):
     def __init__(self, bloglike_lines=False, url_protocols=None,
                  wiki_words=False):
         c = re.compile
+        self.bloglike_lines = bloglike_lines
+        # handler tables of the parsers, see Parser._dispatch(); they live
+        # as long as these rules and go away with them
+        self.dispatch = {}
         # For pre escaping, in creole 1.0 done with ~:
         self.pre_escape_re = c(self.pre_escape, re.M | re.X)
+        if url_protocols is not None:
+            self.proto = '|'.join(re.escape(p) for p in url_protocols)
+        up_case = u''
+        if wiki_words:
+            import unicodedata
+            up_case = u''.join(unichr(i) for i in xrange(sys.maxunicode)
+                               if unicodedata.category(unichr(i))=='Lu')
+        self.chars = self.chars % (up_case, self.proto)
         # for link descriptions
         self.link_re = c('|'.join([self.image, self.linebreak,
-                                   self.char]), re.X | re.U)
+                                   self.chars, self.char]), re.X | re.U)
         # for list items
         self.item_re = c(self.item, re.X | re.U | re.M)
         # for table cells
@@ -126,8 +147,6 @@ class Rules(object):
                                     self.text]), re.X | re.U | re.M)
 
         # For inline elements:
-        if url_protocols is not None:
-            self.proto = '|'.join(re.escape(p) for p in url_protocols)
         self.url =  r'''(?P<url>
             (^ | (?<=\s | [.,:;!?()/=]))
             (?P<escaped_url>~)?
@@ -136,11 +155,34 @@ class Rules(object):
         inline_elements = [self.link, self.url, self.macro,
                            self.code, self.image, self.strong,
                            self.emph, self.linebreak,
-                           self.escape, self.char]
+                           self.escape, self.chars, self.char]
         if wiki_words:
-            import unicodedata
-            up_case = u''.join(unichr(i) for i in xrange(sys.maxunicode)
-                               if unicodedata.category(unichr(i))=='Lu')
             self.wiki = ur'''(?P<wiki>[%s]\w+[%s]\w+)''' % (up_case, up_case)
             inline_elements.insert(3, self.wiki)
         self.inline_re = c('|'.join(inline_elements), re.X | re.U)
+
+
+_rules_cache = {}
+_rules_lock = threading.Lock()
+
+def get_rules(bloglike_lines=False, url_protocols=None, wiki_words=False):
+    """
+    Return a shared Rules instance for the given options.
+
+    Compiling the rules is expensive (especially with wiki_words, which
+    scans the whole unicode range), so every configuration is compiled
+    once per process and reused by all parsers. Rules objects are never
+    modified after construction, so sharing them between threads is safe.
+    """
+
+    if url_protocols is not None:
+        url_protocols = tuple(url_protocols)
+    key = (bool(bloglike_lines), url_protocols, bool(wiki_words))
+    rules = _rules_cache.get(key)
+    if rules is None:
+        with _rules_lock:
+            rules = _rules_cache.get(key)
+            if rules is None:
+                rules = Rules(bloglike_lines, url_protocols, wiki_words)
+                _rules_cache[key] = rules
+    return rules
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+ur"""
+Compact serialization of the document tree.
+
+The tree is stored as one flat array in preorder: for every node its kind
+number and number of children, then its content, then - only for nodes
+that have them - level, preformatted kind and macro arguments. The array
+is written with marshal and compressed, loading it back is several times
+faster than parsing the source again.
+
+>>> import creole
+>>> from creole.html_emitter import HtmlEmitter
+>>> text = u'= Title\n* one **two**\n|a|=b|\n\n{{{#!python\nx\n}}}\n<<recent(5)>>'
+>>> data = dumps(creole.Parser(text).parse())
+>>> print HtmlEmitter(loads(data)).emit() == HtmlEmitter(creole.Parser(text).parse()).emit()
+True
+>>> emit(data) == HtmlEmitter(creole.Parser(text).parse()).emit()
+True
+>>> loads('junk')
+Traceback (most recent call last):
+...
+ValueError: not a serialized document
+"""
+
+import zlib
+import marshal
+
+from creole.document import DocNode
+from creole.html_emitter import HtmlEmitter
+
+
+# Change it whenever the parser builds different trees for the same text,
+# stored documents of other versions are rejected by loads()
+FORMAT = 1
+
+_EXTRA = 0x100  # kind number flag: level, sect and args follow
+
+def dumps(root):
+    """Return the document tree as a compressed string."""
+
+    kinds = {}
+    flat = []
+    add = flat.append
+    stack = [root]
+    pop = stack.pop
+    while stack:
+        node = pop()
+        code = kinds.get(node.kind)
+        if code is None:
+            code = kinds[node.kind] = len(kinds)
+        if node.level is None and node.sect is None and node.args is None:
+            add(code)
+            add(len(node.children))
+            add(node.content)
+        else:
+            add(code | _EXTRA)
+            add(len(node.children))
+            add(node.content)
+            add(node.level)
+            add(node.sect)
+            add(node.args)
+        stack.extend(reversed(node.children))
+    names = [None] * len(kinds)
+    for kind, code in kinds.iteritems():
+        names[code] = kind
+    return zlib.compress(marshal.dumps((FORMAT, tuple(names), tuple(flat)), 2))
+
+def _load(data):
+    try:
+        format, names, flat = marshal.loads(zlib.decompress(data))
+    except (zlib.error, ValueError, EOFError, TypeError):
+        raise ValueError('not a serialized document')
+    if format != FORMAT:
+        raise ValueError('serialized document format %r, expected %r'
+                         % (format, FORMAT))
+    return names, flat
+
+def loads(data):
+    """Return the document tree of a string made by dumps()."""
+
+    names, flat = _load(data)
+    root = None
+    # open nodes with the number of children still to be read
+    stack = []
+    i = 0
+    end = len(flat)
+    while i < end:
+        code = flat[i]
+        parent = stack[-1][0] if stack else None
+        node = DocNode(names[code & ~_EXTRA], parent, flat[i + 2])
+        count = flat[i + 1]
+        if code & _EXTRA:
+            node.level = flat[i + 3]
+            node.sect = flat[i + 4]
+            node.args = flat[i + 5]
+            i += 6
+        else:
+            i += 3
+        if root is None:
+            root = node
+        if stack:
+            stack[-1][1] -= 1
+            if not stack[-1][1]:
+                stack.pop()
+        if count:
+            stack.append([node, count])
+    return root
+
+def emit(data, emitter=HtmlEmitter, **options):
+    """Return the output of the emitter for a string made by dumps()."""
+
+    return emitter(loads(data), **options).emit()
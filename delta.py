@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+r''' Revision texts stored as line deltas of an earlier revision
+
+>>> base = u'one\ntwo\nthree\n'
+>>> data = make_delta(base, u'one\n2\nthree\nfour\n')
+>>> apply_delta(base, data)
+u'one\n2\nthree\nfour\n'
+>>> apply_delta(u'other\n', data)
+Traceback (most recent call last):
+    ...
+ValueError: delta made from another base text
+>>> decompress(compress(u'\u0416'))
+u'\u0416'
+'''
+
+import zlib
+import marshal
+import difflib
+
+
+# revisions between two full copies of the page text
+KEYFRAME_EVERY = 20
+
+
+def compress(text):
+	''' Full copy of the text '''
+	return zlib.compress(text.encode('utf-8'), 9)
+
+def decompress(data):
+	return zlib.decompress(data).decode('utf-8')
+
+def make_delta(base, text):
+	''' Line delta turning the base text into the text
+
+	Lines kept from the base are stored as (start, end) ranges of base
+	lines, everything else as the inserted text. The checksum of the base
+	catches a delta applied to another text than it was made from.
+	'''
+	old = base.splitlines(True)
+	new = text.splitlines(True)
+	ops = []
+	matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+	for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+		if tag == 'equal':
+			ops.append((i1, i2))
+		elif j2 > j1:
+			ops.append(u''.join(new[j1:j2]))
+	return zlib.compress(marshal.dumps((_checksum(base), ops), 2), 9)
+
+def apply_delta(base, data):
+	''' Text of the delta made by make_delta() from the base text '''
+	checksum, ops = marshal.loads(zlib.decompress(data))
+	if checksum != _checksum(base):
+		raise ValueError('delta made from another base text')
+	lines = base.splitlines(True)
+	result = []
+	for op in ops:
+		if isinstance(op, tuple):
+			result.extend(lines[op[0]:op[1]])
+		else:
+			result.append(op)
+	return u''.join(result)
+
+def _checksum(text):
+	return zlib.crc32(text.encode('utf-8')) & 0xffffffff
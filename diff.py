@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+r''' Changes between two revision texts
+
+Opcodes turn the first sequence into the second, as those of difflib:
+
+>>> for code in opcodes('abcd', 'acbd'):
+...     print code
+('equal', 0, 1, 0, 1)
+('delete', 1, 2, 1, 1)
+('equal', 2, 3, 1, 2)
+('insert', 3, 3, 2, 3)
+('equal', 3, 4, 3, 4)
+
+>>> a, b = 'kitten', 'sitting'
+>>> ''.join(a[i1:i2] if tag == 'equal' else b[j1:j2] for tag, i1, i2, j1, j2 in opcodes(a, b))
+'sitting'
+
+Hunks keep context lines around the changes, lines changed in place
+are compared word by word:
+
+>>> for hunk in diff(u'1\n2\n3\n4\n5\n6\n7\n8\n9', u'1\n2\n3\n4 x\n5\n6\n7\n8\n9 y', context=1):
+...     print '--'
+...     for line in hunk:
+...         print line
+--
+('equal', u'3', u'3')
+('replace', u'4', u'4<ins> x</ins>')
+('equal', u'5', u'5')
+--
+('equal', u'8', u'8')
+('replace', u'9', u'9<ins> y</ins>')
+
+>>> diff(u'<b>\nsame', u'<i>\nsame')
+[[('replace', u'&lt;<del>b</del>&gt;', u'&lt;<ins>i</ins>&gt;'), ('equal', u'same', u'same')]]
+>>> diff(u'same', u'same')
+[]
+'''
+
+import re
+import cgi
+
+
+# lines of unchanged text around changes
+CONTEXT = 3
+# edit cost after which a part of the texts is shown replaced as a whole
+MAX_COST = 500
+
+_word_re = re.compile(r'\w+|\s+|[^\w\s]', re.U)
+
+
+def _middle_snake(a, b, a0, a1, b0, b1):
+	''' Middle snake of the shortest edit path, Myers' linear space variant
+
+	Returns the start and end of the diagonal in the middle of the path,
+	or None when the edit cost is over MAX_COST.
+	'''
+	n, m = a1 - a0, b1 - b0
+	delta = n - m
+	odd = delta % 2
+	# furthest x on diagonal k, forward from the start and backward from the end
+	forward = {1: 0}
+	backward = {1: 0}
+	for d in xrange(min((n + m + 1) // 2, MAX_COST) + 1):
+		for k in xrange(-d, d + 1, 2):
+			if k == -d or (k != d and forward[k - 1] < forward[k + 1]):
+				x = forward[k + 1]
+			else:
+				x = forward[k - 1] + 1
+			y = x - k
+			x0, y0 = x, y
+			while x < n and y < m and a[a0 + x] == b[b0 + y]:
+				x += 1
+				y += 1
+			forward[k] = x
+			if odd and -d < delta - k < d and x + backward[delta - k] >= n:
+				return a0 + x0, b0 + y0, a0 + x, b0 + y
+		for k in xrange(-d, d + 1, 2):
+			if k == -d or (k != d and backward[k - 1] < backward[k + 1]):
+				x = backward[k + 1]
+			else:
+				x = backward[k - 1] + 1
+			y = x - k
+			x0, y0 = x, y
+			while x < n and y < m and a[a1 - 1 - x] == b[b1 - 1 - y]:
+				x += 1
+				y += 1
+			backward[k] = x
+			if not odd and -d <= delta - k <= d and x + forward[delta - k] >= n:
+				return a1 - x, b1 - y, a1 - x0, b1 - y0
+	return None
+
+def matching_blocks(a, b):
+	''' (i, j, size) of the equal runs of the sequences, in order
+
+	Memory stays linear in the length of the sequences, unlike the
+	table of a classic longest common subsequence.
+	'''
+	blocks = []
+	parts = [(0, len(a), 0, len(b))]
+	while parts:
+		a0, a1, b0, b1 = parts.pop()
+		start = a0
+		while a0 < a1 and b0 < b1 and a[a0] == b[b0]:
+			a0 += 1
+			b0 += 1
+		if a0 > start:
+			blocks.append((start, b0 - (a0 - start), a0 - start))
+		end = a1
+		while a1 > a0 and b1 > b0 and a[a1 - 1] == b[b1 - 1]:
+			a1 -= 1
+			b1 -= 1
+		if a1 < end:
+			blocks.append((a1, b1, end - a1))
+		if a0 == a1 or b0 == b1:
+			continue
+		snake = _middle_snake(a, b, a0, a1, b0, b1)
+		if snake is None:
+			continue
+		x0, y0, x1, y1 = snake
+		if x1 > x0:
+			blocks.append((x0, y0, x1 - x0))
+		parts.append((a0, x0, b0, y0))
+		parts.append((x1, a1, y1, b1))
+	blocks.sort()
+	return blocks
+
+def opcodes(a, b):
+	''' (tag, i1, i2, j1, j2) turning a into b, tags as in difflib '''
+	result = []
+	i = j = 0
+	for ai, bj, size in matching_blocks(a, b) + [(len(a), len(b), 0)]:
+		if i < ai and j < bj:
+			result.append(('replace', i, ai, j, bj))
+		elif i < ai:
+			result.append(('delete', i, ai, j, bj))
+		elif j < bj:
+			result.append(('insert', i, ai, j, bj))
+		if size:
+			if result and result[-1][0] == 'equal':
+				result[-1] = ('equal', result[-1][1], ai + size, result[-1][3], bj + size)
+			else:
+				result.append(('equal', ai, ai + size, bj, bj + size))
+		i, j = ai + size, bj + size
+	return result
+
+def _words(old, new):
+	''' Html of a changed line pair, changed words marked '''
+	a = _word_re.findall(old)
+	b = _word_re.findall(new)
+	old_html = []
+	new_html = []
+	for tag, i1, i2, j1, j2 in opcodes(a, b):
+		removed = cgi.escape(u''.join(a[i1:i2]))
+		added = cgi.escape(u''.join(b[j1:j2]))
+		if tag == 'equal':
+			old_html.append(removed)
+			new_html.append(added)
+			continue
+		if removed:
+			old_html.append(u'<del>%s</del>' % removed)
+		if added:
+			new_html.append(u'<ins>%s</ins>' % added)
+	return u''.join(old_html), u''.join(new_html)
+
+def diff(old, new, context=CONTEXT):
+	''' Changes between two texts, as hunks of (tag, old line html, new line html)
+
+	Lines changed in place are compared word by word. Hunks keep up to
+	context unchanged lines around their changes.
+	'''
+	a = old.splitlines()
+	b = new.splitlines()
+	codes = opcodes(a, b)
+	hunks = []
+	hunk = []
+	for index, (tag, i1, i2, j1, j2) in enumerate(codes):
+		if tag == 'equal':
+			lines = a[i1:i2]
+			last = index == len(codes) - 1
+			if hunk and (last or len(lines) > 2 * context):
+				# close the hunk after a few lines
+				hunk.extend((tag, cgi.escape(line), cgi.escape(line)) for line in lines[:context])
+				hunks.append(hunk)
+				hunk = []
+			if not hunk:
+				# open the next one a few lines before its change
+				lines = [] if last else lines[max(len(lines) - context, 0):]
+			hunk.extend((tag, cgi.escape(line), cgi.escape(line)) for line in lines)
+			continue
+		for k in xrange(max(i2 - i1, j2 - j1)):
+			removed = a[i1 + k] if i1 + k < i2 else None
+			added = b[j1 + k] if j1 + k < j2 else None
+			if removed is not None and added is not None:
+				hunk.append(('replace',) + _words(removed, added))
+			elif removed is not None:
+				hunk.append(('delete', cgi.escape(removed), u''))
+			else:
+				hunk.append(('insert', u'', cgi.escape(added)))
+	if any(tag != 'equal' for tag, old_html, new_html in hunk):
+		hunks.append(hunk)
+	return hunks
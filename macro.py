@@ -0,0 +1,210 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import re
+import cgi
+import uuid
+import urllib
+import hashlib
+
+from google.appengine.ext import db
+from google.appengine.api import memcache
+
+
+CACHE_MACRO = 'macro:'
+CACHE_MACRO_DEP = 'macro_dep:'
+
+# nested includes deeper than this are left as they are
+MAX_DEPTH = 3
+RECENT_MAX = 50
+
+
+##################
+##   Registry   ##
+##################
+
+class Macro(object):
+	''' Wiki macro, its html is cached per viewer until its dependency is invalidated
+
+	* render(path, args) returns html of the macro on the page at path
+	* depends(path, args) returns the dependency name of the result
+	* check(path, args) is asked on every view if the html may be shown
+	'''
+
+	def __init__(self, render, depends, check=None):
+		self.render = render
+		self.depends = depends
+		self.check = check
+
+MACROS = {}
+
+def register(depends, check=None):
+	''' Register the decorated function as the macro of the same name '''
+	def decorator(render):
+		MACROS[render.__name__] = Macro(render, depends, check)
+		return render
+	return decorator
+
+
+######################
+##   Placeholders   ##
+######################
+
+# Saved page html keeps a placeholder in place of every macro, macros are
+# rendered when the page is viewed, so dynamic lists stay up to date
+_placeholder_re = re.compile(r'<!--macro (\w+)\((.*?)\)-->')
+
+def placeholder(emitter, node):
+	return u'<!--macro %s(%s)-->' % (node.content, emitter.attr_escape(node.args))
+
+def _unescape(text):
+	return text.replace('&quot', '"').replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+
+def _key(prefix, name):
+	# paths are too long for memcache keys
+	return prefix + hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+def _path(path, args):
+	''' Page path of the macro argument, relative to the page at path '''
+	args = args.strip().lower()
+	if not args:
+		return path
+	if args.startswith('/'):
+		return args
+	return path.rstrip('/') + '/' + args
+
+def expand_macros(html, page=None):
+	''' Replace macro placeholders of the saved page html with macro html '''
+	if not html or '<!--macro ' not in html:
+		return html
+	return _expand(html, page.path if page else u'/', 0, _viewer())
+
+def _viewer():
+	''' Who views the page, macros list only pages the viewer can read '''
+	from user import get_user, is_admin
+	if is_admin():
+		return u'admin'
+	user = get_user()
+	return u'user:%d' % user.key().id() if user else u'anonymous'
+
+def _expand(html, path, depth, viewer):
+	calls = {}
+	for m in _placeholder_re.finditer(html):
+		name, args = m.group(1), _unescape(m.group(2))
+		macro = MACROS.get(name)
+		if macro and m.group(0) not in calls:
+			dep = macro.depends(path, args)
+			calls[m.group(0)] = (name, args, macro, _key(CACHE_MACRO_DEP, dep),
+				_key(CACHE_MACRO, u'%s|%s|%s(%s)' % (viewer, dep, name, args)))
+
+	# dependency tokens and results come in a single round trip
+	keys = set()
+	for name, args, macro, dep_key, key in calls.itervalues():
+		keys.add(dep_key)
+		keys.add(key)
+	cached = memcache.get_multi(list(keys))
+
+	# a result is valid while its dependency has the token it was stored with
+	tokens = {}
+	fresh = {}
+	results = {}
+	for source, (name, args, macro, dep_key, key) in calls.iteritems():
+		token = cached.get(dep_key)
+		found = cached.get(key)
+		if token and found and found[0] == token:
+			results[source] = found[1]
+			continue
+		if not token:
+			token = tokens.get(dep_key)
+			if not token:
+				token = tokens[dep_key] = uuid.uuid4().hex
+		results[source] = macro.render(path, args)
+		fresh[key] = (token, results[source])
+
+	if fresh:
+		# results of a dependency invalidated meanwhile are not stored
+		lost = memcache.add_multi(tokens) if tokens else []
+		for name, args, macro, dep_key, key in calls.itervalues():
+			if dep_key in lost:
+				fresh.pop(key, None)
+		memcache.set_multi(fresh)
+
+	def replace(m):
+		if m.group(0) not in calls:
+			return m.group(0)
+		name, args, macro, dep_key, key = calls[m.group(0)]
+		if macro.check and not macro.check(path, args):
+			return u''
+		result = results[m.group(0)]
+		if depth < MAX_DEPTH and '<!--macro ' in result:
+			result = _expand(result, _path(path, args), depth + 1, viewer)
+		return result
+	return _placeholder_re.sub(replace, html)
+
+def dependency_keys(html, page=None):
+	''' Memcache keys of the dependency tokens of the macros in the saved page html '''
+	if not html or '<!--macro ' not in html:
+		return []
+	path = page.path if page else u'/'
+	keys = set()
+	for m in _placeholder_re.finditer(html):
+		macro = MACROS.get(m.group(1))
+		if macro:
+			keys.add(_key(CACHE_MACRO_DEP, macro.depends(path, _unescape(m.group(2)))))
+	return sorted(keys)
+
+def macro_keys(path):
+	''' Memcache keys to delete when the page at path changes '''
+	from page import index_path
+	deps = [u'recent', u'page:' + path] + [u'children:' + p for p in index_path(path)]
+	return [_key(CACHE_MACRO_DEP, dep) for dep in deps]
+
+def invalidate_macros(path):
+	''' Drop cached macro html depending on the page at path '''
+	memcache.delete_multi(macro_keys(path))
+
+
+################
+##   Macros   ##
+################
+
+def _link(page):
+	return u'<li><a href="%s">%s</a></li>' % (
+		cgi.escape(urllib.quote(page.path.encode('utf-8')), True),
+		cgi.escape(page.name or page.path))
+
+@register(lambda path, args: u'children:' + _path(path, args))
+def children(path, args):
+	''' <<children>> or <<children(path)>>: list of subpages '''
+	from page import PageIndex, visible_pages
+	path = _path(path, args)
+	keys = []
+	for key in PageIndex.all(keys_only=True).filter('path', path).fetch(1000):
+		keys.append(db.Key.from_path('Page', key.id()))
+	pages = visible_pages(page for page in db.get(keys) if page and page.path != path)
+	pages.sort(key=lambda page: page.path)
+	return u'<ul class="macro-children">%s</ul>' % u''.join(_link(page) for page in pages)
+
+@register(lambda path, args: u'recent')
+def recent(path, args):
+	''' <<recent>> or <<recent(count)>>: recently updated pages '''
+	from page import Page, visible_pages
+	count = min(int(args), RECENT_MAX) if args.strip().isdigit() else 10
+	pages = visible_pages(Page.all().order('-updated').fetch(RECENT_MAX))[:count]
+	return u'<ul class="macro-recent">%s</ul>' % u''.join(_link(page) for page in pages)
+
+def _can_include(path, args):
+	from page import get_page, check_access
+	page = get_page(_path(path, args))
+	return page is not None and check_access(page)
+
+@register(lambda path, args: u'page:' + _path(path, args), _can_include)
+def include(path, args):
+	''' <<include(path)>>: html of another page '''
+	from page import get_page, get_body
+	page = get_page(_path(path, args))
+	return get_body(page) if page else u''
+
+
+# macros argument of HtmlEmitter
+PLACEHOLDERS = dict((name, placeholder) for name in MACROS)
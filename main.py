@@ -49,8 +49,9 @@ def create_app(app_name, user):
 
 	# Create guide page
 	text = _WELCOME_GUIDE
-	from page import create_page
+	from page import create_page, set_paths_added
 	create_page('/', u'Главная', admin.key().id(), text)
+	set_paths_added()
 
 	return True
 
@@ -5,9 +5,18 @@ import webapp2
 import logging
 import jinja2
 import os
+import re
+import uuid
 import urllib
-import zlib
+import cgi
+import urlparse
 import json
+import functools
+import time
+import datetime
+import hashlib
+import calendar
+import email.utils
 
 from google.appengine.ext import db
 from google.appengine.ext import blobstore
@@ -19,9 +28,17 @@ from google.appengine.api import mail
 from google.appengine.api import namespace_manager
 
 from creole import Parser
-from creole.html_emitter import HtmlEmitter
+from creole.multi_emitter import MultiEmitter
+from creole.blocks import BlockRenderer
+from creole.bulk import render_many
+from creole.serialize import dumps, loads, emit
 
-from user import User, get_user_by_id, get_user, is_admin, auth, login_url, logout_url
+import diff
+import delta
+from cache import LRUCache
+from macro import PLACEHOLDERS, expand_macros, invalidate_macros, macro_keys, dependency_keys
+
+from user import User, get_user_by_id, get_users_by_id, get_user, is_admin, auth, login_url, logout_url
 
 ##################
 ###   Models   ###
@@ -39,14 +56,23 @@ class Markup():
 	HTML = 'HTML'
 
 # Main class to store wiki-page
+# Rendered html is in PageBody, so listings and access checks
+# do not load it, use get_body(page)
 class Page(db.Model):
 	path = db.StringProperty(required=True)
 	name = db.TextProperty()
-	html = db.TextProperty() #required=True
-	updated = db.DateTimeProperty(auto_now=True)
+	old_html = db.TextProperty(name='html') # before PageBody, see move_page_bodies()
+	# set by changes of the page, not by tasks storing derived fields
+	updated = db.DateTimeProperty()
 	user_id = db.IntegerProperty()
 	f_cnt = db.IntegerProperty(default=0) # files counter
 	access = db.StringProperty(default=Access.PARENT)
+	# access resolved through PARENT pages, see update_access()
+	# PARENT here means no page above decides: any signed in user
+	effective_access = db.StringProperty(indexed=False)
+	effective_user_id = db.IntegerProperty(indexed=False)
+	# id of the latest History, saved with it
+	head = db.IntegerProperty(indexed=False)
 
 	# url path
 	# for root return empty string to avoid //.edit urls
@@ -54,15 +80,60 @@ class Page(db.Model):
 		p = self.path
 		return p if p != '/' else ''
 
+class PageBody(db.Model):
+	''' Rendered html of the page, key id is the page id '''
+	html = db.TextProperty()
+
+	@staticmethod
+	def key_for(page):
+		return db.Key.from_path('PageBody', page.key().id())
+
 class History(db.Model):
 	page = db.ReferenceProperty(reference_class=Page, collection_name='history', required=True)
+	# compressed text, or with chain the delta from the last revision of the chain
 	zipp = db.BlobProperty(required=True)
+	# ids of the revisions the text is built from, full copy first
+	chain = db.ListProperty(int, indexed=False)
 	markup = db.StringProperty(default=Markup.WIKI)
-	updated = db.DateTimeProperty(auto_now=True)
+	# set on save only, so re-encoding the text keeps the revision date
+	updated = db.DateTimeProperty()
 	user_id = db.IntegerProperty()
 
-	def html(self):
-		return zlib.decompress(self.zipp).decode('utf-8')
+	def page_key(self):
+		''' Key of the page, without loading it '''
+		return History.page.get_value_for_datastore(self)
+
+	def html(self, known=None):
+		''' Source text of the revision, known maps ids to revisions already loaded '''
+		if not self.chain:
+			return delta.decompress(self.zipp)
+		if known is None:
+			known = {}
+		# the whole chain in one get, each revision is then built from its own base
+		missing = [id for id in self.chain if id not in known]
+		if missing:
+			for history in db.get([db.Key.from_path('History', id) for id in missing]):
+				known[history.key().id()] = history
+		return delta.apply_delta(known[self.chain[-1]].html(known), self.zipp)
+
+def encode_text(text, base=None, base_text=None):
+	''' zipp and chain of a revision: delta from the base revision, or the full text '''
+	zipp = delta.compress(text)
+	if base and len(base.chain) + 1 < delta.KEYFRAME_EVERY:
+		data = delta.make_delta(base_text if base_text is not None else base.html(), text)
+		if len(data) < len(zipp):
+			return data, base.chain + [base.key().id()]
+	return zipp, []
+
+class HistoryTree(db.Model):
+	''' Serialized document tree of a wiki revision, key id is the revision id '''
+	ast = db.BlobProperty()
+	# date of the revision parsed, autosave rewrites the last revision
+	updated = db.DateTimeProperty(indexed=False)
+
+	@staticmethod
+	def key_for(history):
+		return db.Key.from_path('HistoryTree', history.key().id())
 
 class File(db.Model):
 	page = db.ReferenceProperty(reference_class=Page, collection_name='files', required=True)
@@ -73,12 +144,28 @@ class File(db.Model):
 	blob = blobstore.BlobReferenceProperty(required=True)
 	# url = db.StringProperty()
 
+	def blob_key(self):
+		''' Key of the blob, without loading its BlobInfo '''
+		return File.blob.get_value_for_datastore(self)
+
 class PageIndex(db.Model):
 	''' Usefull to move page clusters and show subpages '''
 	path = db.StringListProperty(required=True)
 	# store random mark to determine 
 	# we have already moved page in case of failure
 
+class PagePath(db.Model):
+	''' Page id by path, key name is the lowercase path '''
+	page_id = db.IntegerProperty(indexed=False, required=True)
+
+	@staticmethod
+	def key_for(path):
+		return db.Key.from_path('PagePath', path.lower())
+
+class Migration(db.Model):
+	''' Finished migration of the namespace, key name is the migration '''
+	done = db.DateTimeProperty(auto_now_add=True)
+
 class Subscribe(db.Model):
 	page = db.ListProperty(item_type=int, default=[])
 	cluster = db.ListProperty(item_type=int, default=[])
@@ -101,6 +188,34 @@ class Subscribe(db.Model):
 
 CACHE_PAGE = 'page:'
 CACHE_FILES = 'files:'
+CACHE_FILE_NAMES = 'file_names:'
+CACHE_RESPONSE = 'response:'
+CACHE_BODY = 'body:'
+CACHE_BLOCK = 'block:'
+CACHE_REVISION = 'revision:'
+CACHE_AST = 'ast:'
+CACHE_DIFF = 'diff:'
+CACHE_SOURCE = 'source:'
+CACHE_LINKS = 'links:'
+CACHE_PATHS_ADDED = 'paths_added' # every page has its path entity, see add_page_paths()
+CACHE_PATHS = 'paths' # token of the set of existing page paths
+
+# Salt of rendered block cache keys, change it with the emitted HTML
+# and run the migration to render stored pages again
+RENDER_VERSION = '1'
+
+# revisions on a page of the history view
+HISTORY_PAGE = 50
+
+# larger document trees do not fit in an entity and are parsed again
+MAX_TREE = 1000 * 1000
+
+# file urls with the blob key as version never change
+FILE_MAX_AGE = 365 * 24 * 3600
+
+# page views of signed in users carry an upload url, browser copies
+# are not reused after it may have expired
+UPLOAD_URL_TTL = 600
 
 #################
 ##    Pages    ##
@@ -108,90 +223,374 @@ CACHE_FILES = 'files:'
 
 def create_page(path, name, user_id, text):
 	''' Create new page '''
-	page = Page(path=path, name=name, user_id=user_id)
+	page = new_page(path, name=name, user_id=user_id)
 	_update_page(page, text, markup=Markup.WIKI)
 
+def new_page(path, **kwargs):
+	''' Unsaved page with an allocated id, saved in one batch with its entities '''
+	start, end = db.allocate_ids(db.Key.from_path('Page', 1), 1)
+	return Page(key=db.Key.from_path('Page', start), path=path, **kwargs)
+
 def _update_page(page, text, markup, history_id=None):
 	new = False if page.is_saved() else True
+	if not page.has_key():
+		# page not made by new_page() gets its id from a put
+		page.put()
 
-	# update page content
+	# last revision, the base of the new one, and the id of the new one
+	# load while the page is rendered
+	if page.head:
+		latest = db.get_async(db.Key.from_path('History', page.head))
+	elif not new:
+		# pages saved before the head pointer
+		latest = page.history.order('-updated').run(limit=1)
+	ids = None
+	if not history_id or history_id != page.head:
+		ids = db.allocate_ids_async(db.Key.from_path('History', 1), 1)
+
+	# update page content, text and outline for the search index
+	# come from the same rendering
+	outputs = None
 	if markup == Markup.WIKI:
-		html = convert(text)
+		outputs = _renderer.render_outputs(text)
+		html = outputs.html
 	else:
 		html = text
-	page.html = html
-	page.put()
-	
-	# update revision history
-	zipp = zlib.compress(text.encode('utf-8'), 9)
-	if history_id:
-		history = History.get_by_id(history_id)
-		history.zipp=zipp
+	page.old_html = None
+	access_changed = update_access(page)
+
+	# update revision history, stored as a delta from the previous revision
+	if page.head:
+		base = latest.get_result()
+	else:
+		base = None if new else next(iter(latest), None)
+	if history_id and base and base.key().id() == history_id:
+		# autosave rewrites the last revision, nothing is built from it yet
+		history = base
+		base = History.get_by_id(history.chain[-1]) if history.chain else None
+		history.zipp, history.chain = encode_text(text, base)
 	else:
-		history = History(page=page.key(), zipp=zipp, user_id=page.user_id)
+		zipp, chain = encode_text(text, base)
+		start, end = (ids or db.allocate_ids_async(db.Key.from_path('History', 1), 1)).get_result()
+		history = History(key=db.Key.from_path('History', start), page=page.key(),
+			zipp=zipp, chain=chain, user_id=page.user_id)
 	history.markup = markup
-	history.put()
+	history.updated = page.updated = datetime.datetime.utcnow()
+	page.head = history.key().id()
+
+	# page, body, revision, path index and lookup in one batch
+	page_id = page.key().id()
+	entities = [page, PageBody(key=PageBody.key_for(page), html=html), history]
+	if new:
+		entities.append(PageIndex(key=db.Key.from_path('PageIndex', page_id), path=index_path(page.path)))
+		entities.append(PagePath(key=PagePath.key_for(page.path), page_id=page_id))
+	rpc = db.put_async(entities)
+
+	# post-save work fans out from a single task
+	search = _search_fields(outputs) if outputs else ()
+	outdated = macro_keys(page.path) + ([CACHE_PATHS] if new else [])
+	rpc.get_result()
 
 	# update cache
-	set_page(page.path, page)
+	cached = {
+		CACHE_BODY + str(page_id): html,
+		_source_key(page): (markup, text),
+	}
+	if outputs:
+		# link targets for red links, the missing ones are looked up on view
+		cached[_links_key(page)] = (None, outputs.links, None)
+	set_page(page.path, page, cached)
+	memcache.delete_multi(outdated)
+
+	deferred.defer(after_save, page_id, page.path, new or access_changed, *search,
+		history_id=history.key().id())
 
-	# add path index
-	if new:
-		deferred.defer(add_page_index, page.key().id(), page.path)
+	return history.key().id()
+
+def after_save(page_id, path, access_changed, text=None, headings=None, links=None, history_id=None):
+	''' Post-save task, notifications go last so a retry does not send them twice '''
+	# document tree to emit the revision again without parsing
+	if history_id:
+		store_tree(history_id)
+
+	# pages below inherit access of the new page or its new owner
+	if access_changed:
+		update_access_tree(path)
 
 	# add to search index
 	from search import update_page_search
-	deferred.defer(update_page_search, page.key().id())
+	update_page_search(page_id, text, headings, links)
 
 	# notify subscribers
-	deferred.defer(notify_page, page.key().id())
+	notify_page(page_id)
 
-	return history.key().id()
+def _search_fields(outputs):
+	# text, heading titles and links of a wiki page, see update_page_search()
+	return outputs.text, [title for level, title in outputs.headings], outputs.links
 
+def index_page(page_id):
+	''' Index the page from its latest revision, with the fields of a save '''
+	from search import update_page_search
+	page = Page.get_by_id(page_id)
+	if page is None:
+		return
+	if page.head:
+		history = History.get_by_id(page.head)
+	else:
+		# pages saved before the head pointer
+		history = page.history.order('-updated').get()
+	if history is None or history.markup != Markup.WIKI:
+		update_page_search(page_id)
+		return
+	update_page_search(page_id, *_search_fields(history_outputs(history)))
 
 def _move_page(page, index, path):
 	''' Update dependent entities '''
 
 	# move page		
+	old_path = page.path
+	invalidate_macros(page.path)
 	page.path = path 
+	update_access(page)
+	page.updated = datetime.datetime.utcnow()
 	page.put()
-	# update index
+	# update index and path lookup
 	index.path = index_path(path)
-	index.put()
-
-	# clear page cache
-	memcache.delete(CACHE_PAGE+page.path)
+	ref = PagePath(key=PagePath.key_for(path), page_id=page.key().id())
+	db.put([index, ref])
+	old_ref = PagePath.get(PagePath.key_for(old_path))
+	if old_ref and old_ref.page_id == page.key().id():
+		old_ref.delete()
+
+	# clear page cache, the new path may have a tombstone
+	clear_page(old_path)
+	set_page(page.path, page)
+	invalidate_macros(page.path)
+	invalidate_paths()
 
 	# update search index
-	from search import update_page_search
-	deferred.defer(update_page_search, page.key().id())
+	deferred.defer(index_page, page.key().id())
 
 	# TODO: notify subscribers
 	# deferred.defer(notify_page, page.key().id())
 
 
-def get_page(path):
+# Hot pages are kept in the instance in front of memcache: a request
+# asks for the page and its PARENT access ancestors several times.
+# Other instances see a changed page at most PAGE_TTL seconds later.
+# Handlers change pages in place, so every request gets its own copy
+# decoded from the stored entity.
+PAGE_TTL = 5
+_pages = LRUCache(1000, ttl=PAGE_TTL)
+
+# Tombstone cached for paths without a page, so crawlers, typos and
+# broken links do not query the datastore on every request. Creating
+# or moving a page to the path replaces it with set_page().
+NO_PAGE = ''
+NO_PAGE_TTL = 600
+
+# Whole views of PUBLIC pages for anonymous visitors, the same for all of
+# them. Memcache keeps them under the page etag, which changes with the
+# page and what its macros and red links show, and the requested path,
+# which breadcrumbs show. The instance keeps the view of the last path
+# asked for a page for PAGE_TTL seconds, like pages: it is answered
+# without an access check, so a page made private on another instance
+# is still shown here for up to PAGE_TTL seconds.
+_responses = LRUCache(200, ttl=PAGE_TTL)
+
+def _response_key(etag, path):
+	if isinstance(path, unicode):
+		path = path.encode('utf-8')
+	return CACHE_RESPONSE + etag[1:-1] + ':' + hashlib.sha1(path).hexdigest()
+
+def _page_path(path):
 	if not isinstance(path, unicode):
 		path = unicode(path, 'utf-8')
-	path = path.lower()
+	return path.lower()
+
+def _local_key(path):
+	# instances serve all namespaces, memcache keeps them apart
+	return (namespace_manager.get_namespace(), path)
+
+def get_page(path, fresh=False):
+	''' Page at the path, fresh skips the instance cache that may be seconds old
+	and tombstones, so a page is not created twice
+	'''
+	path = _page_path(path)
+
+	data = None if fresh else _pages.get(_local_key(path))
+	if data == NO_PAGE:
+		return None
+	if data is not None:
+		return db.model_from_protobuf(data)
 
 	key = CACHE_PAGE + path
 	page = memcache.get(key)
+	if page == NO_PAGE:
+		if not fresh:
+			_pages.set(_local_key(path), NO_PAGE)
+			return None
+		page = None
 	if page is None:
 		log.info('Load page from DB')
-		found = Page.all().filter('path', path).fetch(1)
-		if found:
-			page = found[0]
+		page = load_page(path)
+		if page:
 			memcache.set(key, page)
+		else:
+			# a page created since the load is not hidden
+			memcache.add(key, NO_PAGE, time=NO_PAGE_TTL)
+			_pages.set(_local_key(path), NO_PAGE)
+			return None
+	_pages.set(_local_key(path), db.model_to_protobuf(page).Encode())
 	return page
 
-def set_page(path, page):
-	if not isinstance(path, unicode):
-		path = unicode(path, 'utf-8')
-	path = path.lower()
+def load_page(path):
+	''' Page at the lowercase path from the datastore, two key gets '''
+	ref = PagePath.get(PagePath.key_for(path))
+	if ref:
+		page = Page.get_by_id(ref.page_id)
+		# the lookup of a page being moved away may still be there
+		return page if page and page.path.lower() == path else None
+	if paths_added():
+		return None
+
+	# pages before the path lookup, see add_page_paths()
+	found = Page.all().filter('path', path).fetch(1)
+	# the query is eventually consistent, the page may have moved since
+	if not found or found[0].path.lower() != path:
+		return None
+	page = found[0]
+	PagePath(key=PagePath.key_for(path), page_id=page.key().id()).put()
+	return page
 
-	key = CACHE_PAGE + path
-	memcache.set(key, page)
+def set_page(path, page, also=None):
+	''' Cache the page, with also other memcache entries in the same call '''
+	path = _page_path(path)
+
+	mapping = dict(also or {})
+	mapping[CACHE_PAGE + path] = page
+	memcache.set_multi(mapping)
+	_pages.set(_local_key(path), db.model_to_protobuf(page).Encode())
+	_responses.delete(_local_key(path))
+
+def clear_page(*paths):
+	''' Drop pages from both cache tiers '''
+	paths = [_page_path(path) for path in paths]
+	memcache.delete_multi(paths, key_prefix=CACHE_PAGE)
+	_pages.delete_multi([_local_key(path) for path in paths])
+	_responses.delete_multi([_local_key(path) for path in paths])
+
+def invalidate_paths():
+	''' Page created, moved or deleted: cached red links are outdated '''
+	memcache.delete(CACHE_PATHS)
+
+def _revision_key(history):
+	# only the head revision changes, on autosave, and with it its time
+	return '%d:%s' % (history.key().id(), history.updated.isoformat())
+
+def history_html(history):
+	''' Html of the revision, cached for good '''
+	if history.markup != Markup.WIKI:
+		return history.html()
+
+	key = CACHE_REVISION + RENDER_VERSION + ':' + _revision_key(history)
+	html = memcache.get(key)
+	if html is None:
+		html = _history_html(history)
+		memcache.set(key, html)
+	return html
+
+def store_tree(history_id):
+	''' Parse a wiki revision once, off the request, and store its document tree '''
+	history = History.get_by_id(history_id)
+	if history is None or history.markup != Markup.WIKI:
+		return
+	ast = dumps(Parser(history.html()).parse())
+	memcache.set(CACHE_AST + _revision_key(history), ast)
+	if len(ast) < MAX_TREE:
+		HistoryTree(key=HistoryTree.key_for(history), ast=ast, updated=history.updated).put()
+
+def history_tree(history, tree=False):
+	''' Serialized document tree of a wiki revision or None, tree is its HistoryTree if loaded '''
+	key = CACHE_AST + _revision_key(history)
+	ast = memcache.get(key)
+	if ast is not None:
+		return ast
+	if tree is False:
+		tree = db.get(HistoryTree.key_for(history))
+	if not tree or tree.updated != history.updated:
+		return None
+	memcache.set(key, tree.ast)
+	return tree.ast
+
+def _history_html(history):
+	# emitted from the stored document tree
+	ast = history_tree(history)
+	if ast:
+		try:
+			return emit(ast, _emitter)
+		except ValueError:
+			# stored by another format version
+			pass
+
+	# revisions saved before trees were stored
+	return emit(dumps(Parser(history.html()).parse()), _emitter)
+
+def history_outputs(history):
+	''' Outputs of a wiki revision, emitted from its stored document tree '''
+	ast = history_tree(history)
+	if ast:
+		try:
+			return _emitter(loads(ast)).emit_outputs()
+		except ValueError:
+			# stored by another format version
+			pass
+	return _renderer.render_outputs(history.html())
+
+def history_diff(history):
+	''' Previous revision and the diff hunks from it, cached for good '''
+	key = CACHE_DIFF + _revision_key(history)
+	result = memcache.get(key)
+	if result is None:
+		previous = History.all().filter('page', history.page_key()).filter(
+			'updated <', history.updated).order('-updated').get()
+		# revisions share the chain they are built from
+		known = {}
+		old = previous.html(known) if previous else u''
+		hunks = diff.diff(old, history.html(known))
+		result = (previous.key().id() if previous else None, hunks)
+		memcache.set(key, result)
+	return result
+
+def get_source(page):
+	''' Markup and source text of the latest revision '''
+	if not page.head:
+		# pages saved before the head pointer
+		history = page.history.order('-updated').fetch(1)[0]
+		return history.markup, history.html()
+
+	key = _source_key(page)
+	result = memcache.get(key)
+	if result is None:
+		history = History.get_by_id(page.head)
+		result = (history.markup, history.html())
+		# the text stored by a save in the meantime wins
+		memcache.add(key, result)
+	return result
+
+def _source_key(page):
+	# autosave rewrites the head revision, the page version tells them apart
+	return CACHE_SOURCE + '%d:%s' % (page.head, page.updated.isoformat())
+
+def get_body(page):
+	''' Rendered html of the page '''
+	key = CACHE_BODY + str(page.key().id())
+	html = memcache.get(key)
+	if html is None:
+		body = PageBody.get(PageBody.key_for(page))
+		html = body.html if body else page.old_html or u''
+		memcache.set(key, html)
+	return html
 
 def get_files(page):
 	if page.f_cnt == 0:
@@ -205,10 +604,242 @@ def get_files(page):
 		memcache.set(key, files)
 	return files
 
+def get_file_names(page):
+	''' Blob key and upload time of page files by name, the newest of a name '''
+	if page.f_cnt == 0:
+		return {}
+
+	key = CACHE_FILE_NAMES + str(page.key().id())
+	names = memcache.get(key)
+	if names is None:
+		names = {}
+		for file in sorted(page.files.fetch(1000), key=lambda file: file.date):
+			names[file.name] = (str(file.blob_key()), file.date)
+		memcache.set(key, names)
+	return names
+
+def clear_files(page):
+	''' Page files uploaded or deleted '''
+	memcache.delete_multi([CACHE_FILES + page.path, CACHE_FILE_NAMES + str(page.key().id())])
+
 def delete_page_file(file):
 	file.blob.delete()
 	file.delete() # maybe just set flag removed
 
+###################
+##   Red links   ##
+###################
+
+_scheme_re = re.compile(r'^[a-zA-Z][\w+.-]*:')
+
+def _link_path(base, href):
+	''' Page path of an internal link on the page at base, or None '''
+	href = href.split('#')[0].split('?')[0]
+	if not href or href.startswith('//') or _scheme_re.match(href):
+		return None
+	path = urlparse.urljoin(base, href).lower()
+	# files and page actions
+	if '/.' in path:
+		return None
+	if len(path) > 1:
+		path = path.rstrip('/')
+	return path
+
+def find_missing(paths):
+	''' Paths of pages which do not exist, in one memcache and one datastore get '''
+	paths = list(paths)
+	cached = memcache.get_multi(paths, key_prefix=CACHE_PAGE)
+	missing = set(path for path, page in cached.iteritems() if page == NO_PAGE)
+	rest = [path for path in paths if path not in cached]
+	refs = db.get([PagePath.key_for(path) for path in rest]) if rest else []
+	# no tombstones here: pages of a tenant not migrated yet have no path entity
+	lost = [path for path, ref in zip(rest, refs) if ref is None]
+	return frozenset(missing.union(lost))
+
+def paths_added():
+	''' True once every page of the namespace has its path entity
+
+	New pages and page views add path entities before add_page_paths()
+	ran, only its marker tells the namespace is migrated.
+	'''
+	added = memcache.get(CACHE_PATHS_ADDED)
+	if added is None:
+		added = Migration.get_by_key_name(CACHE_PATHS_ADDED) is not None
+		# not migrated yet is checked again soon
+		memcache.set(CACHE_PATHS_ADDED, added, 0 if added else NO_PAGE_TTL)
+	return added
+
+def set_paths_added():
+	''' Mark the namespace migrated, a new one has no pages to migrate '''
+	Migration(key_name=CACHE_PATHS_ADDED).put()
+	memcache.set(CACHE_PATHS_ADDED, True)
+
+def _links_key(page):
+	return CACHE_LINKS + '%d:%s' % (page.key().id(), page.updated.isoformat())
+
+def _link_targets(page):
+	''' Link targets of the page as listed by the emitter, none for html markup '''
+	markup, text = get_source(page)
+	if markup != Markup.WIKI:
+		return []
+	# blocks come from the render cache
+	return _renderer.render_outputs(text).links
+
+def _href(target):
+	# as written by HtmlEmitter.attr_escape()
+	return cgi.escape(target).replace('"', '&quot')
+
+def mark_missing(html, page):
+	''' Add class "missing" to links to not existing pages
+
+	Link targets of a page version are cached with the missing ones,
+	which are looked up again when any page is created, moved or deleted.
+	'''
+	if not html or page is None or '<a href="' not in html:
+		return html
+
+	key = _links_key(page)
+	cached = memcache.get_multi([CACHE_PATHS, key])
+	token = cached.get(CACHE_PATHS)
+	found = cached.get(key)
+	if token and found and found[0] == token:
+		missing = found[2]
+	else:
+		targets = found[1] if found else _link_targets(page)
+		paths = dict((target, _link_path(page.path, target)) for target in targets)
+		if not any(paths.itervalues()):
+			missing = []
+		elif not paths_added():
+			# every page would be missing before the migration
+			return html
+		else:
+			lost = find_missing(set(path for path in paths.itervalues() if path))
+			missing = [target for target in targets if paths[target] in lost]
+		if not token:
+			token = uuid.uuid4().hex
+			if not memcache.add(CACHE_PATHS, token):
+				token = None
+		if token:
+			memcache.set(key, (token, targets, missing))
+
+	for target in missing:
+		href = _href(target)
+		html = html.replace(u'<a href="%s">' % href, u'<a href="%s" class="missing">' % href)
+	return html
+
+################
+##   Access   ##
+################
+
+def _parent_page(page):
+	parents = index_path(page.path)
+	if len(parents) == 1:
+		return None
+	return get_page(parents[-2])
+
+def _effective_access(page, parent):
+	''' (access, owner id) of the page under the parent page '''
+	if page.access != Access.PARENT:
+		return page.access, page.user_id
+	if parent is None:
+		return Access.PARENT, None
+	return effective_access(parent)
+
+def effective_access(page):
+	''' (access, owner id) which decide who can read the page '''
+	if page.effective_access:
+		return page.effective_access, page.effective_user_id
+	# pages saved before effective access was stored
+	return _effective_access(page, _parent_page(page))
+
+def update_access(page, parent=False):
+	''' Store effective access of the page before put, return True if changed '''
+	if parent is False:
+		parent = _parent_page(page)
+	access, user_id = _effective_access(page, parent)
+	if (access, user_id) == (page.effective_access, page.effective_user_id):
+		return False
+	page.effective_access = access
+	page.effective_user_id = user_id
+	return True
+
+def _store_access(key, inherited):
+	''' Store effective access on the page read again, return it or None if unchanged
+
+	inherited is the access a PARENT page at its path gets.
+	'''
+	page = db.get(key)
+	if page is None:
+		return None
+	access, user_id = _access_under(page, inherited)
+	if (access, user_id) == (page.effective_access, page.effective_user_id):
+		return None
+	page.effective_access = access
+	page.effective_user_id = user_id
+	# other fields and the update time are kept as they are now
+	page.put()
+	return page
+
+def _access_under(page, inherited):
+	return inherited if page.access == Access.PARENT else (page.access, page.user_id)
+
+def _inherited_access(path, top, pages):
+	''' (access, owner id) a PARENT page at path gets, pages maps paths to pages
+
+	Pages below top may still hold their old effective access, only
+	their own access is used up to top.
+	'''
+	parents = index_path(path)
+	depth = len(index_path(top))
+	while len(parents) > 1:
+		if parents[-2] not in pages:
+			# the instance copy may be older than the access change
+			pages[parents[-2]] = get_page(parents[-2], fresh=True)
+		parent = pages[parents[-2]]
+		if parent is None:
+			break
+		if len(parents) <= depth:
+			# above the changed pages
+			return effective_access(parent)
+		if parent.access != Access.PARENT:
+			return parent.access, parent.user_id
+		parents.pop()
+	return Access.PARENT, None
+
+def update_access_tree(path, cursor=None, batch=100):
+	''' Store effective access of the page at path and all pages below it '''
+	query = PageIndex.all(keys_only=True).filter('path', path)
+	if cursor:
+		query.with_cursor(cursor)
+	keys = query.fetch(batch)
+	pages = {}
+	for page in db.get([db.Key.from_path('Page', key.id()) for key in keys]) if keys else []:
+		if page:
+			pages[page.path] = page
+	if not cursor and path not in pages:
+		# index of a new page may be not added yet
+		page = load_page(_page_path(path))
+		if page:
+			pages[page.path] = page
+
+	# batches come in any order, so every page is resolved up the tree
+	changed = []
+	for page in pages.values():
+		inherited = _inherited_access(page.path, path, pages)
+		if _access_under(page, inherited) == (page.effective_access, page.effective_user_id):
+			continue
+		stored = db.run_in_transaction(_store_access, page.key(), inherited)
+		if stored:
+			changed.append(stored)
+
+	clear_page(*[page.path for page in changed])
+	# listings by macros depend on who can read the pages
+	memcache.delete_multi(list(set(key for page in changed for key in macro_keys(page.path))))
+	log.info('Access changed on %d of %d pages under "%s"', len(changed), len(pages), path)
+
+	if len(keys) == batch:
+		deferred.defer(update_access_tree, path, query.cursor(), batch)
+
 def breadcrumbs(path):
 	path = unicode(path, 'utf-8')
 	result = []
@@ -232,6 +863,7 @@ def index_path(path):
 		result.append(current)
 	return result
 
+# queued by saves before the batched save pipeline
 def add_page_index(page_id, path):
 	index = PageIndex(key=db.Key.from_path('PageIndex', page_id), path=index_path(path))
 	index.put()
@@ -283,9 +915,31 @@ def _send_notification(u, page, from_email):
 ###   Server   ###
 ##################
 
-def convert(text):
-	document = Parser(text).parse()
-	return HtmlEmitter(document).emit()
+class BlockCache(object):
+	''' Rendered wiki blocks: in-instance LRU in front of memcache '''
+
+	def __init__(self, size):
+		self.local = LRUCache(size)
+
+	def get_multi(self, keys):
+		result = self.local.get_multi(keys)
+		missed = [key for key in keys if key not in result]
+		if missed:
+			found = memcache.get_multi(missed, key_prefix=CACHE_BLOCK)
+			self.local.set_multi(found)
+			result.update(found)
+		return result
+
+	def set_multi(self, mapping):
+		self.local.set_multi(mapping)
+		memcache.set_multi(mapping, key_prefix=CACHE_BLOCK)
+
+# macros are saved as placeholders and expanded on view
+_emitter = functools.partial(MultiEmitter, macros=PLACEHOLDERS)
+
+# only changed blocks are parsed on save and preview
+_block_cache = BlockCache(2000)
+_renderer = BlockRenderer(_block_cache, salt=RENDER_VERSION, emitter=_emitter)
 
 def dateformat(value, format='%d.%m.%Y %H:%M'):
     return value.strftime(format)
@@ -306,6 +960,41 @@ def size(n):
 		else:
 			return '%d MB' % (n/10**6)
 
+def http_date(value):
+	return email.utils.formatdate(calendar.timegm(value.utctimetuple()), usegmt=True)
+
+def not_modified(request, etag, modified=None):
+	''' Validators of the request match the response, it may be answered with 304 '''
+	match = request.headers.get('If-None-Match')
+	if match:
+		tags = [tag.strip() for tag in match.split(',')]
+		return '*' in tags or etag in tags or 'W/' + etag in tags
+	since = request.headers.get('If-Modified-Since')
+	if since and modified:
+		parsed = email.utils.parsedate_tz(since)
+		# validators are whole seconds
+		return bool(parsed) and email.utils.mktime_tz(parsed) >= calendar.timegm(modified.utctimetuple())
+	return False
+
+def page_etag(page, user):
+	''' Entity tag of the page view and if it is final
+
+	It changes with the page, the viewer and the tokens of what macros
+	and red links show. Tokens not set yet are set by the rendering, the
+	tag is not final then and is taken again after it.
+	'''
+	keys = [CACHE_PATHS] + dependency_keys(get_body(page), page)
+	tokens = memcache.get_multi(keys)
+	parts = [RENDER_VERSION, page.key().id(), page.updated.isoformat(), page.head]
+	if is_admin():
+		parts.append('admin')
+	elif user:
+		parts.append(user.key().id())
+		parts.append(int(time.time() // UPLOAD_URL_TTL))
+	parts.extend(tokens.get(key) for key in keys)
+	etag = '"%s"' % hashlib.sha1(repr(parts)).hexdigest()
+	return etag, len(tokens) == len(keys)
+
 def user_name(user_id):
 	return get_user_by_id(user_id).name
 
@@ -315,6 +1004,20 @@ def encode(url):
 def not_empty(l):
 	return len(l) > 0
 
+def visible_pages(pages):
+	''' Pages the current user can read, like check_access() with one user lookup '''
+	if is_admin():
+		return list(pages)
+	user = get_user()
+	result = []
+	for page in pages:
+		access, user_id = effective_access(page)
+		if Access.PUBLIC == access:
+			result.append(page)
+		elif user and (Access.PARENT == access or user.key().id() == user_id):
+			result.append(page)
+	return result
+
 def check_access(page):
 	'''Check current user can access this page
 
@@ -328,31 +1031,25 @@ def check_access(page):
 	if page is None:
 		return get_user() is not None
 
-	if Access.PUBLIC == page.access:
+	access, user_id = effective_access(page)
+
+	if Access.PUBLIC == access:
 		return True
 
-	if Access.PARENT == page.access:
-		parents = index_path(page.path)
-		if len(parents) == 1: 
-			return get_user() is not None
-		parents.reverse()
-		# for path in parents[1]:
-		path = parents[1]
-		page = get_page(path)
-		return check_access(page)
-		
-		# return True
+	# no page above decides
+	if Access.PARENT == access:
+		return get_user() is not None
 
-	if Access.PRIVATE == page.access:
+	if Access.PRIVATE == access:
 		user = get_user()
 		# TODO: store private user list in separate entity
-		if user and user.key().id() == page.user_id:
+		if user and user.key().id() == user_id:
 			return True
 		else:
 			log.info('No access to "%s"', page.path)
 			return False
 
-	raise Exception('Unsupported access type '+page.access)
+	raise Exception('Unsupported access type '+access)
 
 
 
@@ -363,6 +1060,8 @@ jinja_environment.filters['format'] = dateformat
 jinja_environment.filters['size'] = size
 jinja_environment.filters['user_name'] = user_name
 jinja_environment.filters['urlencode'] = encode
+jinja_environment.filters['macros'] = expand_macros
+jinja_environment.filters['missing'] = mark_missing
 jinja_environment.tests['not_empty'] = not_empty
 jinja_environment.tests['access'] = check_access
 
@@ -376,32 +1075,85 @@ class GetPage(webapp2.RequestHandler):
 	# Unauthorized users can get PUBLIC pages
 	def get(self, path):
 		if not path: path = '/'
+		user = get_user()
+		if not user:
+			# anonymous view of a public page seen in the last seconds
+			cached = _responses.get(_local_key(_page_path(path)))
+			if cached and cached[0] == path:
+				log_stat('GetPage')
+				self.write_cached(*cached[1:])
+				return
+
 		page = get_page(path)
 		
 		# User may be not authorized
 		if not check_access(page):
 			self.redirect(login_url())
+			return
 
 		# logs for metrics
 		log_stat('GetPage')
 
+		if page:
+			# the browser copy is current: no files, upload url or rendering
+			etag, final = page_etag(page, user)
+			self.response.headers['Cache-Control'] = 'private, no-cache'
+			self.response.headers['Last-Modified'] = http_date(page.updated)
+			# the view changes with the viewer, macros and red links while
+			# the page stays the same, only the tag validates it
+			if not_modified(self.request, etag):
+				self.response.headers['ETag'] = etag
+				self.response.set_status(304)
+				return
+
+		# anonymous views of public pages are the same for everyone
+		shared = page is not None and not user and effective_access(page)[0] == Access.PUBLIC
+		if shared:
+			cached = memcache.get(_response_key(etag, path))
+			if cached:
+				_responses.set(_local_key(_page_path(path)), (path,) + cached)
+				self.write_cached(*cached)
+				return
+
 		values = {'page': page, 'breadcrumbs': breadcrumbs(path)}
 		if page:
+			values['html'] = get_body(page)
+		if user and page:
+			# only the page menu of signed in users shows them
 			values['files'] = get_files(page)
 			# TODO: lazy load
 			values['upload'] = blobstore.create_upload_url(encode(page.upath()+'/.files'))
-		if not get_user():
+		if not user:
 			values['public'] = True
 		
 		template = jinja_environment.get_template('get.html')
-		self.response.out.write(template.render(values))
+		html = template.render(values)
+		if page:
+			if not final:
+				etag = page_etag(page, user)[0]
+			self.response.headers['ETag'] = etag
+		if shared:
+			cached = (etag, http_date(page.updated), html)
+			memcache.set(_response_key(etag, path), cached)
+			_responses.set(_local_key(_page_path(path)), (path,) + cached)
+		self.response.out.write(html)
+
+	def write_cached(self, etag, modified, html):
+		self.response.headers['Cache-Control'] = 'private, no-cache'
+		self.response.headers['Last-Modified'] = modified
+		self.response.headers['ETag'] = etag
+		if not_modified(self.request, etag):
+			self.response.set_status(304)
+			return
+		self.response.out.write(html)
 
 	@auth
 	def post(self):
 		'''Preview formated page while editing wiki'''
 		text = self.request.get('text')
-		html = convert(text)
-		self.response.out.write(html)
+		# parts go out as they are rendered, macros never span two of them
+		write = self.response.out.write
+		_renderer.stream(text, lambda html: write(expand_macros(html)))
 
 
 class EditPage(webapp2.RequestHandler):
@@ -409,7 +1161,8 @@ class EditPage(webapp2.RequestHandler):
 	@auth
 	def get(self, path):
 		if not path: path = '/'
-		page = get_page(path)
+		# the editor starts from the latest save
+		page = get_page(path, fresh=True)
 		name = self.request.get('name')
 
 		values = {'page': page, 'breadcrumbs': breadcrumbs(path), 'name': name}
@@ -418,9 +1171,7 @@ class EditPage(webapp2.RequestHandler):
 			values['files'] = get_files(page)
 			values['upload'] = blobstore.create_upload_url(encode(page.upath()+'/.files'))
 
-			history = page.history.order('-updated').fetch(1)[0]
-			values['text'] = history.html()
-			values['markup'] = history.markup
+			values['markup'], values['text'] = get_source(page)
 			
 		template = jinja_environment.get_template('edit.html')
 		self.response.out.write(template.render(values))
@@ -429,13 +1180,14 @@ class EditPage(webapp2.RequestHandler):
 	def post(self, path):
 		if not path: path = '/'
 		path = path.lower()
-		page = get_page(path)
+		# saves build on the latest revision
+		page = get_page(path, fresh=True)
 
 		# logs for metrics
 		log_stat('EditPage')
 
 		if not page:
-			page = Page(path=unicode(path, 'utf-8'))
+			page = new_page(unicode(path, 'utf-8'))
 
 		name = self.request.get('name')
 		text = self.request.get('text')
@@ -457,7 +1209,8 @@ class EditPage(webapp2.RequestHandler):
 	def put(self, path):
 		if not path: path = '/'
 		path = path.lower()
-		page = get_page(path)
+		# saves build on the latest revision
+		page = get_page(path, fresh=True)
 
 		# logs for metrics
 		log_stat('EditPage')
@@ -471,7 +1224,7 @@ class EditPage(webapp2.RequestHandler):
 
 
 		if not page:
-			page = Page(path=unicode(path, 'utf-8'))
+			page = new_page(unicode(path, 'utf-8'))
 		elif page.updated.strftime('%s') != updated:
 			# TODO: add message
 			log.info('Page is not up to date %d',int(page.updated.strftime('%s')))
@@ -512,14 +1265,19 @@ class DeletePage(webapp2.RequestHandler):
 
 		page_id = page.key().id()
 		index = PageIndex.get_by_id(page_id)
-		page.delete()
-		index.delete()
+		db.delete([page, index, PageBody.key_for(page), PagePath.key_for(page.path)])
 
-		memcache.delete(CACHE_PAGE+path)
+		clear_page(path)
+		memcache.delete(CACHE_BODY+str(page_id))
+		invalidate_macros(page.path)
+		invalidate_paths()
 
 		from search import delete_page_search
 		deferred.defer(delete_page_search, page_id)
 
+		# pages below lost their parent
+		deferred.defer(update_access_tree, page.path)
+
 		# delete files
 		deferred.defer(_delete_page_files, files)
 
@@ -539,11 +1297,19 @@ class HistoryPage(webapp2.RequestHandler):
 	def get(self, path):
 		if not path: path = '/'
 		page = get_page(path)
-		history = page.history.order('-updated')
+		# only date and author of revisions are shown, read from the index
+		query = History.all(projection=('updated', 'user_id')).filter('page', page).order('-updated')
+		cursor = self.request.get('cursor')
+		if cursor:
+			query.with_cursor(cursor)
+		history = query.fetch(HISTORY_PAGE)
+		users = get_users_by_id(set(item.user_id for item in history if item.user_id))
 
 		values = {
 			'page': page, 
 			'history': history, 
+			'users': users,
+			'cursor': query.cursor() if len(history) == HISTORY_PAGE else None,
 			'breadcrumbs': breadcrumbs(path),
 		}
 		template = jinja_environment.get_template('history.html')
@@ -557,12 +1323,12 @@ class ShowHistoryPage(webapp2.RequestHandler):
 		if not path: path = '/'
 		page = get_page(path)
 		history = History.get_by_id(int(self.request.get('id')))
-		if history.page.key().id() != page.key().id(): return
+		if history.page_key() != page.key(): return
 
 		values = {
 			'page': page, 
 			'history': history, 
-			'html': convert(history.html()),
+			'html': history_html(history),
 			'breadcrumbs': breadcrumbs(path),
 			'user': get_user_by_id(history.user_id)
 		}
@@ -570,6 +1336,28 @@ class ShowHistoryPage(webapp2.RequestHandler):
 		self.response.out.write(template.render(values))
 
 
+class DiffHistoryPage(webapp2.RequestHandler):
+	''' Show changes of page revision from the previous one '''
+	@auth
+	def get(self, path):
+		if not path: path = '/'
+		page = get_page(path)
+		history = History.get_by_id(int(self.request.get('id')))
+		if history.page_key() != page.key(): return
+		previous_id, hunks = history_diff(history)
+
+		values = {
+			'page': page, 
+			'history': history, 
+			'previous_id': previous_id,
+			'hunks': hunks,
+			'breadcrumbs': breadcrumbs(path),
+			'user': get_user_by_id(history.user_id)
+		}
+		template = jinja_environment.get_template('diff.html')
+		self.response.out.write(template.render(values))
+
+
 class MovePage(webapp2.RequestHandler):
 	''' Move to another path either single page or the whole cluster '''
 	@auth
@@ -592,6 +1380,10 @@ class MovePage(webapp2.RequestHandler):
 		# move whole cluster
 		if self.request.get('cluster'):
 			taskqueue.add(url=URL_MOVE_PAGE, params={'from': path, 'to': new_path})
+		else:
+			# pages left below the old path lost their parent
+			deferred.defer(update_access_tree, _page_path(path))
+		deferred.defer(update_access_tree, page.path)
 
 		self.redirect(encode(page.path))
 
@@ -618,6 +1410,9 @@ class MovePageCluster(webapp2.RequestHandler):
 
 				_move_page(page, index, path)
 
+			# moved pages inherit access from the new place
+			deferred.defer(update_access_tree, to_path)
+
 
 class TreePage(webapp2.RequestHandler):
 	''' View subpages '''
@@ -746,10 +1541,17 @@ class AccessPage(webapp2.RequestHandler):
 		
 		page.access = access
 		page.user_id = get_user().key().id()
+		access_changed = update_access(page)
+		page.updated = datetime.datetime.utcnow()
 		page.put()
 
 		# Update page cache
 		set_page(path, page)
+		invalidate_macros(page.path)
+
+		# pages below inherit the new access
+		if access_changed:
+			deferred.defer(update_access_tree, page.path)
 
 		self.redirect(path)
 
@@ -765,18 +1567,35 @@ class EditPageFiles(blobstore_handlers.BlobstoreUploadHandler, blobstore_handler
 		# User may be not authorized
 		if not check_access(page):
 			self.redirect(login_url())
+			return
 
 		# logs for metrics
 		log_stat('GetFile')
 
 		name = unicode(name, 'utf-8')
-		if page:
-			files = page.files.filter('name', name).fetch(1)
-			if files:
-				self.send_blob(files[0].blob)
-				return
-		
-		self.error(404)
+		found = get_file_names(page).get(name) if page else None
+		if not found:
+			self.error(404)
+			return
+		blob_key, date = found
+
+		# a blob never changes, its key is the entity tag
+		etag = '"%s"' % blob_key
+		headers = self.response.headers
+		headers['ETag'] = etag
+		if date:
+			headers['Last-Modified'] = http_date(date)
+		cache = 'public' if effective_access(page)[0] == Access.PUBLIC else 'private'
+		if self.request.get('v') == blob_key:
+			headers['Cache-Control'] = '%s, max-age=%d' % (cache, FILE_MAX_AGE)
+		else:
+			# another upload may take the name
+			headers['Cache-Control'] = '%s, no-cache' % cache
+
+		if not_modified(self.request, etag, date):
+			self.response.set_status(304)
+			return
+		self.send_blob(blobstore.BlobKey(blob_key), use_range=True)
 
 	@auth	
 	def post(self, path):
@@ -797,11 +1616,12 @@ class EditPageFiles(blobstore_handlers.BlobstoreUploadHandler, blobstore_handler
 
 		# increment files counter in Page
 		page.f_cnt = page.f_cnt + 1
+		page.updated = datetime.datetime.utcnow()
 		page.put()
 		# update cache
 		set_page(page.path, page)
 
-		memcache.delete(CACHE_FILES + path)
+		clear_files(page)
 
 		deferred.defer(notify_page, page.key().id())
 
@@ -820,20 +1640,184 @@ class EditPageFiles(blobstore_handlers.BlobstoreUploadHandler, blobstore_handler
 
 			# decrease files counter in Page
 			page.f_cnt = page.f_cnt - 1
+			page.updated = datetime.datetime.utcnow()
 			page.put()
 			# update cache
 			set_page(page.path, page)
 
-			memcache.delete(CACHE_FILES + path)
+			clear_files(page)
 			deferred.defer(notify_page, page.key().id())
 
 
 # Migration
 
 def migrate():
-	from search import update_page_search
-	for page in Page.all():
-		deferred.defer(update_page_search, page.key().id())
+	for key in Page.all(keys_only=True):
+		deferred.defer(index_page, key.id())
+	deferred.defer(add_page_paths)
+	deferred.defer(move_page_bodies)
+	deferred.defer(rerender_pages)
+	deferred.defer(update_access_tree, u'/')
+	deferred.defer(encode_history)
+
+def add_page_paths(cursor=None, batch=500):
+	''' Add path lookup entities of pages saved before them '''
+	query = Page.all()
+	if cursor:
+		query.with_cursor(cursor)
+	pages = query.fetch(batch)
+	if pages:
+		db.put([PagePath(key=PagePath.key_for(page.path), page_id=page.key().id()) for page in pages])
+		log.info('Added %d page paths' % len(pages))
+
+	if len(pages) == batch:
+		deferred.defer(add_page_paths, query.cursor(), batch)
+	else:
+		set_paths_added()
+		# look up red links found during the migration again
+		invalidate_paths()
+
+def _move_body(key):
+	''' Move html of the page read again to its body, return the page or None '''
+	page, body = db.get([key, db.Key.from_path('PageBody', key.id())])
+	if page is None or page.old_html is None:
+		return None
+	entities = [page]
+	if body is None:
+		entities.append(PageBody(key=PageBody.key_for(page), html=page.old_html))
+	page.old_html = None
+	db.put(entities)
+	return page
+
+def move_page_bodies(cursor=None, batch=100):
+	''' Move html of pages saved before PageBody to their body entities '''
+	query = Page.all()
+	if cursor:
+		query.with_cursor(cursor)
+	pages = query.fetch(batch)
+	if not pages:
+		return
+
+	# page and body change together, a save between the reads retries the move
+	options = db.create_transaction_options(xg=True)
+	moved = []
+	for page in pages:
+		if page.old_html is not None:
+			page = db.run_in_transaction_options(options, _move_body, page.key())
+			if page:
+				moved.append(page)
+	clear_page(*[page.path for page in moved])
+	log.info('Moved %d page bodies' % len(moved))
+
+	if len(pages) == batch:
+		deferred.defer(move_page_bodies, query.cursor(), batch)
+
+def _store_body(key, head, updated, html):
+	''' Store html rendered from the head revision, unless the page was saved since '''
+	page = db.get(key)
+	if page is None or page.head != head or page.updated != updated:
+		return False
+	PageBody(key=PageBody.key_for(page), html=html).put()
+	return True
+
+def rerender_pages(cursor=None, batch=100):
+	''' Render html of all wiki pages again, after the emitter output changed '''
+	query = Page.all()
+	if cursor:
+		query.with_cursor(cursor)
+	pages = query.fetch(batch)
+	if not pages:
+		return
+
+	# pages saved before the head pointer query their last revision,
+	# started before waiting for the first one
+	runs = dict((page.key(), page.history.order('-updated').run(limit=1)) for page in pages if not page.head)
+	keys = [db.Key.from_path('History', page.head) for page in pages if page.head]
+	known = dict((history.key().id(), history) for history in (db.get(keys) if keys else []) if history)
+	heads = []
+	for page in pages:
+		history = known.get(page.head) if page.head else next(iter(runs[page.key()]), None)
+		if history and history.markup == Markup.WIKI:
+			heads.append((page, history))
+	trees = db.get([HistoryTree.key_for(history) for page, history in heads]) if heads else []
+	rendered = []
+	texts = []
+	for (page, history), tree in zip(heads, trees):
+		if history_tree(history, tree):
+			# stored trees are emitted without parsing
+			rendered.append((page, history_html(history)))
+		else:
+			texts.append((page, history.html()))
+	rendered.extend(zip((page for page, text in texts),
+		render_many((text for page, text in texts), emitter=_emitter)))
+
+	# a page saved meanwhile has its body rendered already
+	options = db.create_transaction_options(xg=True)
+	stored = [page.key().id() for page, html in rendered
+		if db.run_in_transaction_options(options, _store_body, page.key(), page.head, page.updated, html)]
+	memcache.delete_multi([str(id) for id in stored], key_prefix=CACHE_BODY)
+	log.info('Rendered %d pages again, %d parsed' % (len(stored), len(texts)))
+
+	if len(pages) == batch:
+		deferred.defer(rerender_pages, query.cursor(), batch)
+
+def encode_history(cursor=None, batch=20):
+	''' Store revisions saved in full as deltas, keeping a full copy every KEYFRAME_EVERY '''
+	query = Page.all(keys_only=True)
+	if cursor:
+		query.with_cursor(cursor)
+	keys = query.fetch(batch)
+	if not keys:
+		return
+
+	for key in keys:
+		encode_page_history(key)
+
+	if len(keys) == batch:
+		deferred.defer(encode_history, query.cursor(), batch)
+
+def encode_page_history(page_key, cursor=None, base_id=None, batch=1000):
+	''' Encode revisions of the page oldest first, longer histories go on in a task
+
+	Autosave rewrites the head revision only, it is left as it is and the
+	next save makes its delta from it. Revisions before it do not change.
+	'''
+	page = db.get(page_key)
+	if page is None:
+		return
+	query = History.all().filter('page', page_key).order('updated')
+	if cursor:
+		query.with_cursor(cursor)
+	revisions = query.fetch(batch)
+	more = len(revisions) == batch
+	ids = [history.key().id() for history in revisions]
+	if page.head in ids:
+		revisions = revisions[:ids.index(page.head)]
+		more = False
+	elif not page.head and not more:
+		# pages saved before the head pointer end with their head
+		revisions = revisions[:-1]
+	known = dict((history.key().id(), history) for history in revisions)
+	# texts before any revision is encoded again
+	texts = [history.html(known) for history in revisions]
+	base = base_text = None
+	if base_id:
+		# last revision of the previous run, already encoded
+		base = History.get_by_id(base_id)
+		base_text = base.html()
+	full = stored = 0
+	for history, text in zip(revisions, texts):
+		full += len(delta.compress(text))
+		history.zipp, history.chain = encode_text(text, base, base_text)
+		stored += len(history.zipp)
+		base, base_text = history, text
+	for i in xrange(0, len(revisions), 500):
+		db.put(revisions[i:i + 500])
+	log.info('Encoded %d revisions of page %d, %d bytes in full, %d stored' % (
+		len(revisions), page_key.id(), full, stored))
+
+	if more:
+		deferred.defer(encode_page_history, page_key, query.cursor(), base.key().id(), batch)
 
 
 page_routes = [
@@ -846,6 +1830,7 @@ page_routes = [
 	('<:.*>/.delete', DeletePage),
 	('<:.*>/.log', HistoryPage),
 	('<:.*>/.show', ShowHistoryPage),
+	('<:.*>/.diff', DiffHistoryPage),
 	('<:.*>/.move', MovePage),
 	('<:.*>/.tree', TreePage),
 	('<:.*>/.subscribe', SubscribePage),
@@ -10,21 +10,28 @@ from google.appengine.api import search
 from google.appengine.ext import db
 
 from user import auth
-from page import Page
+from page import Page, get_body
 
 
 _INDEX_NAME="page"
 
-def update_page_search(page_id):
+def update_page_search(page_id, text=None, headings=None, links=None):
+	''' Index the page, wiki pages pass the plain text rendered on save '''
 	page = Page.get_by_id(page_id)
 	# get last section of path
 	path = page.path[page.path.rindex('/') + 1: ]
+	if text is None:
+		content = search.HtmlField(name='html', value=get_body(page))
+	else:
+		content = search.TextField(name='text', value=text)
 	# add to search index
 	doc = search.Document(doc_id=str(page_id), 
 						fields=[
-							search.HtmlField(name='html', value=page.html),
+							content,
 							search.TextField(name='name', value=page.name),
 							search.TextField(name='path', value=path),
+							search.TextField(name='headings', value=u'\n'.join(headings or [])),
+							search.TextField(name='links', value=u' '.join(links or [])),
 						])
 	try:
 	    search.Index(name=_INDEX_NAME).put(doc)
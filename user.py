@@ -35,6 +35,20 @@ def get_user_by_id(user_id):
 		memcache.set(key, result)
 	return result
 
+def get_users_by_id(user_ids):
+	''' Users by id, looked up with one memcache and one datastore call '''
+	user_ids = [int(user_id) for user_id in user_ids]
+	result = memcache.get_multi([str(user_id) for user_id in user_ids], key_prefix=CACHE_USER_ID)
+	result = dict((int(key), user) for key, user in result.iteritems() if user)
+	missing = [user_id for user_id in user_ids if user_id not in result]
+	if missing:
+		loaded = {}
+		for user_id, user in zip(missing, User.get_by_id(missing)):
+			if user:
+				result[user_id] = loaded[str(user_id)] = user
+		memcache.set_multi(loaded, key_prefix=CACHE_USER_ID)
+	return result
+
 def get_user():		
 	user = users.get_current_user()
 	if not user: